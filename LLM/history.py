@@ -0,0 +1,121 @@
+from array import array
+from typing import Dict, List
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+
+
+def estimate_tokens(text: str) -> int:
+    '''Cheap token estimate, roughly four characters per token'''
+    return len(text) // 4 + 1
+
+
+
+class ChatHistory:
+    '''
+    Chat history kept as ready-to-send LangChain messages
+
+    messages is passed to the prompt as is. When a summary exists it is kept
+    as a SystemMessage in front of the turns. Token estimates of the turns
+    live in a parallel array, so budget checks never walk the messages.
+    '''
+    __slots__ = ('messages', 'tokens', 'total', 'summary')
+
+    def __init__(self):
+        self.messages: List[BaseMessage] = []
+        self.tokens = array('I')
+        self.total = 0
+        self.summary = ''
+
+
+    @property
+    def start(self) -> int:
+        '''Index of the first turn in messages'''
+        return 1 if self.summary else 0
+
+
+    @classmethod
+    def load(cls, data: Dict) -> 'ChatHistory':
+        '''
+        Restore history saved with dump
+
+        :param data: dictionary with summary and turns
+        :return: chat history
+        '''
+        history = cls()
+        for role, content in data.get('turns', []):
+            history.append(HumanMessage(content=content) if role == 'user' else AIMessage(content=content))
+        if data.get('summary'):
+            history.summary = data['summary']
+            history.messages.insert(0, SystemMessage(content=f"Summary of the story so far: {data['summary']}"))
+        return history
+
+
+    def dump(self) -> Dict:
+        '''Compact JSON serializable form of history'''
+        return {
+            'summary': self.summary,
+            'turns': [
+                ['user' if isinstance(msg, HumanMessage) else 'assistant', msg.content]
+                for msg in self.turns()
+            ]
+        }
+
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+
+    def turns(self) -> List[BaseMessage]:
+        '''Turns without the summary message'''
+        return self.messages[self.start:]
+
+
+    def append(self, message: BaseMessage):
+        '''Add a message to the end of history'''
+        tokens = estimate_tokens(message.content)
+        self.messages.append(message)
+        self.tokens.append(tokens)
+        self.total += tokens
+
+
+    def fold(self, count: int, summary: str):
+        '''
+        Replace the oldest turns with a summary
+
+        :param count: number of oldest turns to drop
+        :param summary: summary covering the dropped turns and the previous summary
+        '''
+        start = self.start
+        del self.messages[start:start + count]
+        self.total -= sum(self.tokens[:count])
+        del self.tokens[:count]
+
+        summary_message = SystemMessage(content=f'Summary of the story so far: {summary}')
+        if start:
+            self.messages[0] = summary_message
+        else:
+            self.messages.insert(0, summary_message)
+        self.summary = summary
+
+
+    def window(self, budget: int) -> List[BaseMessage]:
+        '''
+        Messages to send to the model
+
+        :param budget: maximum number of turn tokens
+        :return: the history itself when it fits the budget, otherwise the summary and the newest turns that fit
+        '''
+        if self.total <= budget:
+            return self.messages
+
+        tokens = 0
+        count = 0
+        for turn_tokens in reversed(self.tokens):
+            tokens += turn_tokens
+            if tokens > budget:
+                break
+            count += 1
+
+        newest = self.messages[len(self.messages) - count:] if count else []
+        return self.messages[:self.start] + newest
@@ -0,0 +1,78 @@
+import os
+import asyncio
+import hashlib
+from typing import Dict
+
+from cachetools import TTLCache
+from google.ai.generativelanguage_v1beta import ModelServiceAsyncClient
+from google.api_core import exceptions
+from google.api_core.client_options import ClientOptions
+
+from LLM.pool import DEFAULT_MODEL
+
+
+
+KEY_CHECK_TTL = float(os.getenv('KEY_CHECK_TTL', '600'))
+KEY_CHECK_TIMEOUT = float(os.getenv('KEY_CHECK_TIMEOUT', '5'))
+
+# Errors that prove the key itself is unusable, so the verdict can be cached
+INVALID_KEY_ERRORS = (
+    exceptions.InvalidArgument,
+    exceptions.Unauthenticated,
+    exceptions.PermissionDenied,
+)
+
+_results: TTLCache = TTLCache(maxsize=4096, ttl=KEY_CHECK_TTL)
+_inflight: Dict[str, asyncio.Task] = {}
+
+
+
+def key_hash(api_key: str) -> str:
+    '''Cache key of an API key, so raw keys are never kept in memory longer than needed'''
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+
+async def _check_key(api_key: str, digest: str) -> bool:
+    '''Fetch model metadata with a client of this key only'''
+    client = ModelServiceAsyncClient(client_options=ClientOptions(api_key=api_key))
+    try:
+        await client.get_model(name=f'models/{DEFAULT_MODEL}', retry=None, timeout=KEY_CHECK_TIMEOUT)
+        _results[digest] = True
+        return True
+
+    except INVALID_KEY_ERRORS as e:
+        print(f'API validation failed: {e}')
+        _results[digest] = False
+        return False
+
+    except Exception as e:
+        # Network trouble says nothing about the key, do not cache it
+        print(f'API validation failed: {e}')
+        return False
+
+    finally:
+        await client.transport.close()
+
+
+
+async def validate_api_key(api_key: str) -> bool:
+    '''
+    Check that an API key can use the model
+
+    Uses a metadata request instead of a generation. Verdicts are cached for
+    KEY_CHECK_TTL seconds and concurrent checks of one key share one request.
+
+    :param api_key: API key Google Generative AI
+    :return: True if the key is valid
+    '''
+    digest = key_hash(api_key)
+    if digest in _results:
+        return _results[digest]
+
+    task = _inflight.get(digest)
+    if task is None:
+        task = _inflight[digest] = asyncio.create_task(_check_key(api_key, digest))
+        task.add_done_callback(lambda _: _inflight.pop(digest, None))
+
+    return await asyncio.shield(task)
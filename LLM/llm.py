@@ -1,121 +1,300 @@
+import os
+import time
 import asyncio
-from typing import List, Dict
-from langchain_google_genai import ChatGoogleGenerativeAI
+from contextlib import AsyncExitStack, contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from google.api_core import exceptions
 
+from LLM.history import ChatHistory, estimate_tokens
+from LLM.pool import client_pool
+from LLM.prompts import prompt_cache
+from LLM.resilience import CircuitOpenError, resilience
+from LLM.scheduler import BACKGROUND, INTERACTIVE, QueueFullError, scheduler
+
+
+
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '4000'))
+
+SUMMARY_PROMPT = '''You keep the memory of a roleplay story. Merge the previous summary and the 
+                    new dialogue fragment into one concise summary written in the third person. 
+                    Keep names, relationships, important events, promises and the current situation. 
+                    Answer with the summary only.'''
+
+BUSY_MESSAGE = 'The bot is very busy right now. Please, try again in a minute.'
+# Appended to a streamed reply that broke off, such a reply is not kept in history
+INTERRUPTED_SUFFIX = '\n\n(The reply was cut off. Please, send your message again.)'
+
+# Called with a record dictionary when a model call starts and finishes (metrics, logging)
+call_hooks: List[Callable[[Dict[str, Any]], None]] = []
+
+
+
+@contextmanager
+def observe_call(kind: str, prompt_tokens: int) -> Iterator[Dict[str, Any]]:
+    '''
+    Report a model call to call_hooks
+
+    The caller fills response_chars of the yielded record. An exception
+    leaving the block is recorded by type name and re-raised.
+    '''
+    record = {'event': 'start', 'kind': kind, 'prompt_tokens': prompt_tokens}
+    for hook in call_hooks:
+        hook(record)
+
+    record = {'event': 'finish', 'kind': kind, 'error': None, 'response_chars': 0}
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - started
+        for hook in call_hooks:
+            hook(record)
+
 
 
 class LLMChat:
-    def __init__(self, api_key: str, active_character: Dict, active_persona: Dict):
+    def __init__(self, api_key: str, active_character: Dict, active_persona: Dict,
+                 token_budget: int = HISTORY_TOKEN_BUDGET):
         '''
         Initializing a chat
         
         :param api_key: API key Google Generative AI
         :param active_character: dictionary with id, name and description of active character
         :param active_persona: dictionary with id, name and description of active persona
+        :param token_budget: approximate number of history tokens sent to the model
         '''
         self.api_key = api_key
-        self.chat_history: List[Dict[str, str]] = []
+        self.chat_history = ChatHistory()
+        self.token_budget = token_budget
+        self._compaction: Optional[asyncio.Task] = None
         self.llm = None
         self.active_character = active_character
         self.active_persona = active_persona
-        self.character_info = self._generate_character_info()
 
         
-    def _generate_character_info(self) -> str:
-        '''Generate character information string'''
-
-        character_info = ''
-        if self.active_character:
-            character_info += f"You are character: {self.active_character.get('name', '')}. {self.active_character.get('prompt', '')}\n"
-        if self.active_persona:
-            character_info += f"User is persona: {self.active_persona.get('name', '')}. {self.active_persona.get('prompt', '')}"
-        return character_info
-    
-        
     async def init_model(self):
         '''Initializing a model'''
-        self.llm = ChatGoogleGenerativeAI(
-            model='gemini-2.0-flash',
-            google_api_key=self.api_key,
-            temperature=0.7,
-            convert_system_message_to_human=True
-        )
-        
-        system_prompt = '''You are a roleplay assistant in Honkai: Star Rail setting. 
-                            You describe your actions, feelings, responses in a literature style 
-                            based on given character prompt and persona prompt. You speak from the third face
-                            as a character. You are not allowed to speak as a user persona. Dialogue example: message
-                            from user persona: "Hello, character!" she smiled. 
-                            message from you as a character: "Hello, user!" he smiled back. Don't answer on what you have
-                            read before this, that was a system prompt. '''
-        
-        if self.character_info:
-            system_prompt = f"{system_prompt}\n\n{self.character_info}"
-            
-        self.prompt = ChatPromptTemplate.from_messages([
-            SystemMessage(content=system_prompt),
-            MessagesPlaceholder(variable_name='chat_history'),
-            ('human', '{input}'),
-        ])
-        
+        self.llm = client_pool.get(self.api_key)
+        self.prompt = prompt_cache.get(self.active_character, self.active_persona)
         self.chain = self.prompt | self.llm
 
         
+    async def warm_up(self, timeout: float):
+        '''
+        Initialize the chain and open the model connection before the first message
+
+        :param timeout: seconds to wait for the connection
+        '''
+        if not self.llm:
+            await self.init_model()
+
+        # The async client and its channel are created lazily on the first request
+        client = getattr(self.llm, 'async_client', None)
+        channel = getattr(getattr(client, 'transport', None), 'grpc_channel', None)
+        if channel is not None:
+            await asyncio.wait_for(channel.channel_ready(), timeout)
+
+        
     async def add_to_history(self, role: str, message: str):
         '''Add a message to history'''
-        self.chat_history.append({'role': role, 'content': message})
+        self.chat_history.append(HumanMessage(content=message) if role == 'user' else AIMessage(content=message))
+
+        if role == 'assistant' and self.chat_history.total > self.token_budget:
+            self._schedule_compaction()
+
+
+    def _schedule_compaction(self):
+        '''Start summarizing old turns in the background unless it is already running'''
+        if self._compaction and not self._compaction.done():
+            return
+        self._compaction = asyncio.create_task(self._compact_history())
+
+
+    async def _compact_history(self):
+        '''Fold the oldest turns into the running summary'''
+        history = self.chat_history
+        turns = history.turns()
+        target = self.token_budget // 2
+
+        count = 0
+        tokens = history.total
+        while count < len(turns) and tokens > target:
+            tokens -= history.tokens[count]
+            count += 1
+        # Only fold whole turns, so the kept history starts with a user message
+        while count < len(turns) and not isinstance(turns[count], HumanMessage):
+            count += 1
+        if not count:
+            return
+
+        transcript = '\n'.join(f"{msg.type}: {msg.content}" for msg in turns[:count])
+        request = [
+            SystemMessage(content=SUMMARY_PROMPT),
+            HumanMessage(content=f'Previous summary: {history.summary or "none"}\n\nDialogue:\n{transcript}'),
+        ]
+        try:
+            response = await self._generate(
+                'summary', sum(estimate_tokens(msg.content) for msg in request),
+                lambda: self.llm.ainvoke(request), BACKGROUND)
+        except Exception as e:
+            print(f'Error summarizing history: {e}')
+            return
+
+        # History was cleared while the summary was being generated
+        if history is not self.chat_history:
+            return
+
+        history.fold(count, response.content[:self.token_budget * 2])
+
+        
+    def _build_input(self, user_message: str) -> Dict:
+        '''
+        Build chain input for a new user message
+
+        The history list is passed without copying while it fits the token
+        budget. Only while a compaction is still running is it cut down to the
+        newest messages, so the prompt stays bounded either way.
+        '''
+        return {
+            'input': user_message,
+            'chat_history': self.chat_history.window(self.token_budget)
+        }
+
+
+    def _prompt_tokens(self, user_message: str) -> int:
+        '''Estimated history and message tokens of a request, without the system prompt'''
+        return min(self.chat_history.total, self.token_budget) + estimate_tokens(user_message)
+
+
+    async def _generate(self, kind: str, prompt_tokens: int, func: Callable[[], Awaitable],
+                        priority: int = INTERACTIVE, on_queued: Optional[Callable[[int], Awaitable]] = None):
+        '''
+        Call the model with retries, holding a generation slot only during each attempt
+
+        The slot is given back before a retry backs off, so a key hitting its
+        quota does not keep slots idle while other keys wait. Only the first
+        attempt tells the user about the queue.
+        '''
+        notify = on_queued
+
+        async def attempt():
+            nonlocal notify
+            queued, notify = notify, None
+            async with scheduler.slot(self.api_key, priority, queued):
+                with observe_call(kind, prompt_tokens) as record:
+                    response = await func()
+                    record['response_chars'] = len(response.content)
+                    return response
+
+        return await resilience.call(self.api_key, attempt)
 
         
-    async def get_response(self, user_message: str) -> str:
+    async def get_response(self, user_message: str,
+                           on_queued: Optional[Callable[[int], Awaitable]] = None) -> str:
         '''
         Get a response
         
         :param user_message: message from user
+        :param on_queued: awaited with the queue position if the request has to wait
         :return: model response
         '''
         if not self.llm:
             await self.init_model()
-            
-        await self.add_to_history('user', user_message)
         
-        input_data = {
-            'input': user_message,
-            'chat_history': [
-                HumanMessage(content=msg['content']) if msg['role'] == 'user' 
-                else AIMessage(content=msg['content'])
-                for msg in self.chat_history[:-1] 
-            ]
-        }
+        input_data = self._build_input(user_message)
 
         try:
-            response = await self.chain.ainvoke(input_data)
+            response = await self._generate(
+                'response', self._prompt_tokens(user_message),
+                lambda: self.chain.ainvoke(input_data), on_queued=on_queued)
+            await self.add_to_history('user', user_message)
             await self.add_to_history('assistant', response.content)
             return response.content
 
-        except exceptions.ResourceExhausted as e:
+        except QueueFullError:
+            return BUSY_MESSAGE
+        except (exceptions.ResourceExhausted, CircuitOpenError) as e:
             return 'Looks like you have reached your limit. Please, return later.'
         except Exception:
             return 'Looks like something is wrong. Please, try again later.'
+
+
+    async def stream_response(self, user_message: str,
+                              on_queued: Optional[Callable[[int], Awaitable]] = None) -> AsyncIterator[str]:
+        '''
+        Stream a response chunk by chunk
+        
+        :param user_message: message from user
+        :param on_queued: awaited with the queue position if the request has to wait
+        :return: async iterator over text chunks of model response
+        '''
+        if not self.llm:
+            await self.init_model()
+        
+        input_data = self._build_input(user_message)
+        response = ''
+        notify = on_queued
+
+        async def open_stream():
+            # Only the request up to the first chunk is retried, each attempt takes its own slot
+            nonlocal notify
+            queued, notify = notify, None
+            held = AsyncExitStack()
+            await held.enter_async_context(scheduler.slot(self.api_key, on_queued=queued))
+            record = held.enter_context(observe_call('stream', self._prompt_tokens(user_message)))
+            stream = self.chain.astream(input_data)
+            held.push_async_callback(stream.aclose)
+            try:
+                return held, record, stream, await anext(stream, None)
+            except BaseException as e:
+                await held.__aexit__(type(e), e, e.__traceback__)
+                raise
+
+        try:
+            held, record, stream, chunk = await resilience.call(self.api_key, open_stream)
+            async with held:
+                while chunk is not None:
+                    if chunk.content:
+                        response += chunk.content
+                        record['response_chars'] = len(response)
+                        yield chunk.content
+                    chunk = await anext(stream, None)
+
+        except QueueFullError:
+            yield BUSY_MESSAGE
+            return
+        except (exceptions.ResourceExhausted, CircuitOpenError) as e:
+            yield INTERRUPTED_SUFFIX if response else 'Looks like you have reached your limit. Please, return later.'
+            return
+        except Exception:
+            yield INTERRUPTED_SUFFIX if response else 'Looks like something is wrong. Please, try again later.'
+            return
+
+        if response:
+            await self.add_to_history('user', user_message)
+            await self.add_to_history('assistant', response)
         
     
     
     async def update_character(self, new_character: Dict):
         '''Update active character and refresh system prompt'''
         self.active_character = new_character
-        self.character_info = self._generate_character_info()
         await self.init_model() 
 
         
     async def update_persona(self, new_persona: Dict):
         '''Update active persona and refresh system prompt'''
         self.active_persona = new_persona
-        self.character_info = self._generate_character_info()
         await self.init_model()  
 
     
     async def clear_history(self):
         '''Clear chat history'''
-        self.chat_history = []
\ No newline at end of file
+        if self._compaction:
+            self._compaction.cancel()
+            self._compaction = None
+        self.chat_history = ChatHistory()
@@ -0,0 +1,152 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_google_genai.chat_models import _response_to_result
+
+
+
+DEFAULT_MODEL = 'gemini-2.0-flash'
+DEFAULT_TEMPERATURE = 0.7
+
+CLIENT_POOL_SIZE = int(os.getenv('CLIENT_POOL_SIZE', '256'))
+CLIENT_POOL_IDLE_TTL = float(os.getenv('CLIENT_POOL_IDLE_TTL', '1800'))
+
+
+
+class GeminiChat(ChatGoogleGenerativeAI):
+    '''
+    Gemini chat client making exactly one request per call
+
+    langchain-google-genai retries every call on its own, and the API client
+    has a default retry policy as well. Both are skipped here, so retries,
+    backoff and the circuit breaker are left to LLM.resilience alone.
+    '''
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        request = self._prepare_request(messages, stop=stop, cached_content=self.cached_content, **kwargs)
+        response = await self.async_client.generate_content(
+            request=request, metadata=self.default_metadata, retry=None)
+        return _response_to_result(response)
+
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        request = self._prepare_request(messages, stop=stop, cached_content=self.cached_content, **kwargs)
+        stream = await self.async_client.stream_generate_content(
+            request=request, metadata=self.default_metadata, retry=None)
+
+        # Usage is reported per chunk relative to the sum of the previous ones
+        usage = None
+        async for response in stream:
+            chunk = _response_to_result(response, stream=True, prev_usage=usage).generations[0]
+            current = chunk.message.usage_metadata
+            if current:
+                usage = current if usage is None else {
+                    field: usage.get(field, 0) + current.get(field, 0)
+                    for field in ('input_tokens', 'output_tokens', 'total_tokens')
+                }
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text)
+            yield chunk
+
+
+
+def create_client(api_key: str, model: str, temperature: float) -> ChatGoogleGenerativeAI:
+    '''Create a Gemini chat client'''
+    return GeminiChat(
+        model=model,
+        google_api_key=api_key,
+        temperature=temperature,
+        convert_system_message_to_human=True
+    )
+
+
+
+class ClientPool:
+    def __init__(self, max_size: int = CLIENT_POOL_SIZE, idle_ttl: float = CLIENT_POOL_IDLE_TTL,
+                 factory: Callable[[str, str, float], ChatGoogleGenerativeAI] = create_client):
+        '''
+        Process-wide pool of Gemini clients
+
+        Clients are keyed by (api_key, model, temperature) and shared between
+        chats, so connections stay warm across sessions. The least recently
+        used client is evicted once the pool is full, and clients unused for
+        longer than idle_ttl are evicted on access.
+
+        :param max_size: maximum number of pooled clients
+        :param idle_ttl: seconds a client may stay unused before eviction
+        :param factory: creates a client from (api_key, model, temperature)
+        '''
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.factory = factory
+        self._clients: OrderedDict[Tuple[str, str, float], Tuple[ChatGoogleGenerativeAI, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def _evict_idle(self, now: float):
+        '''Drop clients that have been idle for longer than idle_ttl'''
+        while self._clients:
+            key, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._clients[key]
+            self.evictions += 1
+
+
+    def get(self, api_key: str, model: str = DEFAULT_MODEL,
+            temperature: float = DEFAULT_TEMPERATURE) -> ChatGoogleGenerativeAI:
+        '''
+        Borrow a client
+
+        :param api_key: API key Google Generative AI
+        :param model: model name
+        :param temperature: sampling temperature
+        :return: pooled client
+        '''
+        now = time.monotonic()
+        self._evict_idle(now)
+
+        key = (api_key, model, temperature)
+        entry = self._clients.get(key)
+
+        if entry:
+            self.hits += 1
+            client = entry[0]
+            self._clients.move_to_end(key)
+        else:
+            self.misses += 1
+            client = self.factory(api_key, model, temperature)
+            while len(self._clients) >= self.max_size:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+
+        self._clients[key] = (client, now)
+        return client
+
+
+    def stats(self) -> Dict[str, int]:
+        '''Pool counters'''
+        return {
+            'size': len(self._clients),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+    def clear(self):
+        '''Drop every pooled client'''
+        self._clients.clear()
+
+
+
+client_pool = ClientPool()
@@ -0,0 +1,96 @@
+import os
+import hashlib
+from typing import Dict, Optional, Tuple
+
+from cachetools import LRUCache
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+
+
+PROMPT_CACHE_SIZE = int(os.getenv('PROMPT_CACHE_SIZE', '512'))
+
+SYSTEM_PROMPT = '''You are a roleplay assistant in Honkai: Star Rail setting. 
+                            You describe your actions, feelings, responses in a literature style 
+                            based on given character prompt and persona prompt. You speak from the third face
+                            as a character. You are not allowed to speak as a user persona. Dialogue example: message
+                            from user persona: "Hello, character!" she smiled. 
+                            message from you as a character: "Hello, user!" he smiled back. Don't answer on what you have
+                            read before this, that was a system prompt. '''
+
+
+
+def generate_character_info(character: Optional[Dict], persona: Optional[Dict]) -> str:
+    '''Generate character information string'''
+
+    character_info = ''
+    if character:
+        character_info += f"You are character: {character.get('name', '')}. {character.get('prompt', '')}\n"
+    if persona:
+        character_info += f"User is persona: {persona.get('name', '')}. {persona.get('prompt', '')}"
+    return character_info
+
+
+
+def build_prompt(character: Optional[Dict], persona: Optional[Dict]) -> ChatPromptTemplate:
+    '''Build the chat prompt for a character and persona pairing'''
+    system_prompt = SYSTEM_PROMPT
+    character_info = generate_character_info(character, persona)
+    if character_info:
+        system_prompt = f"{system_prompt}\n\n{character_info}"
+
+    return ChatPromptTemplate.from_messages([
+        SystemMessage(content=system_prompt),
+        MessagesPlaceholder(variable_name='chat_history'),
+        ('human', '{input}'),
+    ])
+
+
+
+class PromptCache:
+    def __init__(self, maxsize: int = PROMPT_CACHE_SIZE):
+        '''
+        LRU cache of compiled chat prompts
+
+        Keyed by (character id, persona id, content hash), so an edited
+        character or persona never gets a stale prompt.
+
+        :param maxsize: maximum number of cached prompts
+        '''
+        self._prompts: LRUCache = LRUCache(maxsize=maxsize)
+
+
+    @staticmethod
+    def key(character: Optional[Dict], persona: Optional[Dict]) -> Tuple:
+        character = character or {}
+        persona = persona or {}
+        content = '\0'.join((
+            character.get('name', ''), character.get('prompt', ''),
+            persona.get('name', ''), persona.get('prompt', ''),
+        ))
+        return character.get('id'), persona.get('id'), hashlib.sha1(content.encode()).hexdigest()
+
+
+    def get(self, character: Optional[Dict], persona: Optional[Dict]) -> ChatPromptTemplate:
+        '''Get a cached prompt or build and cache it'''
+        key = self.key(character, persona)
+        prompt = self._prompts.get(key)
+        if prompt is None:
+            prompt = self._prompts[key] = build_prompt(character, persona)
+        return prompt
+
+
+    def invalidate_character(self, character_id: int):
+        '''Drop prompts of a deleted character'''
+        for key in [key for key in self._prompts if key[0] == character_id]:
+            self._prompts.pop(key, None)
+
+
+    def invalidate_persona(self, persona_id: int):
+        '''Drop prompts of a deleted persona'''
+        for key in [key for key in self._prompts if key[1] == persona_id]:
+            self._prompts.pop(key, None)
+
+
+
+prompt_cache = PromptCache()
@@ -0,0 +1,191 @@
+import os
+import time
+import random
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from google.api_core import exceptions
+
+
+
+T = TypeVar('T')
+
+RETRY_ATTEMPTS = int(os.getenv('LLM_RETRY_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '1.0'))
+RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', '20'))
+BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '3'))
+BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '60'))
+
+TRANSIENT_ERRORS = (
+    exceptions.ResourceExhausted,
+    exceptions.ServiceUnavailable,
+    exceptions.DeadlineExceeded,
+)
+
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        '''
+        Raised instead of calling the model while a key is over quota
+
+        :param retry_after: seconds until the breaker lets calls through again
+        '''
+        super().__init__(f'Circuit is open for another {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+
+
+def retry_delay(error: Exception) -> Optional[float]:
+    '''
+    Read the retry delay Google attached to an error
+
+    :param error: Google API error
+    :return: delay in seconds or None if there is no hint
+    '''
+    for detail in getattr(error, 'details', None) or ():
+        # gRPC transport returns RetryInfo messages
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+        # REST transport returns plain dictionaries
+        if isinstance(detail, dict) and str(detail.get('@type', '')).endswith('RetryInfo'):
+            try:
+                return float(str(detail.get('retryDelay', '')).rstrip('s'))
+            except ValueError:
+                return None
+    return None
+
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        '''
+        Quota circuit breaker of one API key
+
+        :param threshold: consecutive quota errors that open the breaker
+        :param cooldown: seconds the breaker stays open
+        '''
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0.0
+
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self.opened_until
+
+
+    def check(self):
+        '''Raise CircuitOpenError while the breaker is open'''
+        remaining = self.opened_until - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(remaining)
+
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_until = 0.0
+
+
+    def record_failure(self, retry_after: Optional[float] = None) -> bool:
+        '''
+        Count a quota error
+
+        :param retry_after: delay hint of the error
+        :return: True if the breaker opened
+        '''
+        self.failures += 1
+        if self.failures < self.threshold:
+            return False
+        self.opened_until = time.monotonic() + max(self.cooldown, retry_after or 0)
+        return True
+
+
+
+class Resilience:
+    def __init__(self, attempts: int = RETRY_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY):
+        '''
+        Retries and per-key circuit breakers around model calls
+
+        Transient errors (429, 503, deadline exceeded) are retried with
+        exponential backoff and full jitter, or after the delay Google asks
+        for. Quota errors feed the breaker of the key; while it is open calls
+        fail fast with CircuitOpenError.
+
+        :param attempts: maximum number of attempts per call
+        :param base_delay: backoff delay after the first failure
+        :param max_delay: longest delay worth waiting for
+        '''
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self.counters = {
+            'calls': 0,
+            'retries': 0,
+            'failures': 0,
+            'rejected': 0,
+            'breaker_opened': 0,
+        }
+
+
+    def breaker(self, api_key: str) -> CircuitBreaker:
+        breaker = self._breakers.get(api_key)
+        if not breaker:
+            breaker = self._breakers[api_key] = CircuitBreaker()
+        return breaker
+
+
+    async def call(self, api_key: str, func: Callable[[], Awaitable[T]]) -> T:
+        '''
+        Call the model with retries
+
+        :param api_key: API key the call is made with
+        :param func: factory of the awaitable to run, called once per attempt
+        :return: result of func
+        '''
+        breaker = self.breaker(api_key)
+        self.counters['calls'] += 1
+
+        for attempt in range(1, self.attempts + 1):
+            try:
+                breaker.check()
+            except CircuitOpenError:
+                self.counters['rejected'] += 1
+                raise
+
+            try:
+                result = await func()
+                breaker.record_success()
+                return result
+
+            except TRANSIENT_ERRORS as e:
+                hint = retry_delay(e)
+                if isinstance(e, exceptions.ResourceExhausted) and breaker.record_failure(hint):
+                    self.counters['breaker_opened'] += 1
+
+                delay = hint if hint is not None else random.uniform(0, self.base_delay * 2 ** (attempt - 1))
+                if attempt == self.attempts or breaker.is_open() or delay > self.max_delay:
+                    self.counters['failures'] += 1
+                    raise
+
+                self.counters['retries'] += 1
+                await asyncio.sleep(delay)
+
+            except Exception:
+                self.counters['failures'] += 1
+                raise
+
+
+    def stats(self) -> Dict[str, int]:
+        '''Retry and breaker counters'''
+        return {
+            **self.counters,
+            'open_breakers': sum(breaker.is_open() for breaker in self._breakers.values()),
+        }
+
+
+
+resilience = Resilience()
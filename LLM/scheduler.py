@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional
+
+
+
+GENERATION_CONCURRENCY = int(os.getenv('GENERATION_CONCURRENCY', '32'))
+GENERATION_PER_KEY = int(os.getenv('GENERATION_PER_KEY', '2'))
+GENERATION_QUEUE_SIZE = int(os.getenv('GENERATION_QUEUE_SIZE', '1000'))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = ('interactive', 'background')
+
+
+
+class QueueFullError(Exception):
+    '''Raised instead of queueing a generation when the queue is at its limit'''
+
+
+
+class _Waiter:
+    __slots__ = ('key', 'priority', 'future')
+
+    def __init__(self, key: str, priority: int):
+        self.key = key
+        self.priority = priority
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrent: int = GENERATION_CONCURRENCY, per_key: int = GENERATION_PER_KEY,
+                 max_queue: int = GENERATION_QUEUE_SIZE):
+        '''
+        Admission control for model calls
+
+        At most max_concurrent generations run at once and at most per_key of
+        them for one API key. Waiting calls are grouped by key and served
+        round-robin across keys, so a busy key cannot starve the others.
+        Interactive calls go before background ones such as summaries.
+
+        :param max_concurrent: global limit of running generations
+        :param per_key: limit of running generations per API key
+        :param max_queue: waiting calls beyond which QueueFullError is raised
+        '''
+        self.max_concurrent = max_concurrent
+        self.per_key = per_key
+        self.max_queue = max_queue
+
+        self.running = 0
+        self._running_by_key: Dict[str, int] = {}
+        # One round-robin ring per priority: key -> its waiters, rotated as keys are served
+        self._queues: List[OrderedDict[str, Deque[_Waiter]]] = [OrderedDict() for _ in PRIORITY_NAMES]
+        self.queued = 0
+
+        self.counters = {'admitted': 0, 'waited': 0, 'rejected': 0}
+        # Called with (priority name, seconds waited) whenever a slot is granted
+        self.wait_hooks: List[Callable[[str, float], None]] = []
+
+
+    def _has_capacity(self, key: str) -> bool:
+        return self.running < self.max_concurrent and self._running_by_key.get(key, 0) < self.per_key
+
+
+    def _is_queued(self, key: str) -> bool:
+        return any(key in queues for queues in self._queues)
+
+
+    def _acquire(self, key: str):
+        self.running += 1
+        self._running_by_key[key] = self._running_by_key.get(key, 0) + 1
+        self.counters['admitted'] += 1
+
+
+    def _release(self, key: str):
+        self.running -= 1
+        remaining = self._running_by_key[key] - 1
+        if remaining:
+            self._running_by_key[key] = remaining
+        else:
+            del self._running_by_key[key]
+        self._wake()
+
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        '''Pop the first waiter in round-robin order whose key is below its cap'''
+        for queues in self._queues:
+            for key in list(queues):
+                if self._running_by_key.get(key, 0) >= self.per_key:
+                    continue
+                waiters = queues[key]
+                waiter = None
+                while waiters and waiter is None:
+                    waiter = waiters.popleft()
+                    self.queued -= 1
+                    # Cancelled callers are dropped here, their own cleanup has not run yet
+                    if waiter.future.done():
+                        waiter = None
+                if waiters:
+                    queues.move_to_end(key)
+                else:
+                    del queues[key]
+                if waiter:
+                    return waiter
+        return None
+
+
+    def _wake(self):
+        '''Hand free slots to waiters'''
+        while self.running < self.max_concurrent:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            self._acquire(waiter.key)
+            waiter.future.set_result(None)
+
+
+    def _remove(self, waiter: _Waiter):
+        queues = self._queues[waiter.priority]
+        waiters = queues.get(waiter.key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            if not waiters:
+                del queues[waiter.key]
+
+
+    def position(self, waiter: _Waiter) -> int:
+        '''Approximate 1-based place of a waiter in the round-robin order'''
+        position = 0
+        for priority, queues in enumerate(self._queues):
+            if priority > waiter.priority:
+                break
+            if priority < waiter.priority:
+                position += sum(len(waiters) for waiters in queues.values())
+                continue
+            rank = queues[waiter.key].index(waiter)
+            position += sum(min(len(waiters), rank + 1) for key, waiters in queues.items() if key != waiter.key)
+            position += rank + 1
+        return position
+
+
+    @asynccontextmanager
+    async def slot(self, key: str, priority: int = INTERACTIVE,
+                   on_queued: Optional[Callable[[int], Awaitable]] = None) -> AsyncIterator[None]:
+        '''
+        Hold a generation slot for the duration of the block
+
+        :param key: API key the call is made with
+        :param priority: INTERACTIVE or BACKGROUND
+        :param on_queued: awaited with the queue position if the call has to wait
+        :raises QueueFullError: the queue is at max_queue
+        '''
+        started = time.monotonic()
+
+        if self._has_capacity(key) and not self._is_queued(key):
+            self._acquire(key)
+        else:
+            if self.queued >= self.max_queue:
+                self.counters['rejected'] += 1
+                raise QueueFullError(f'{self.queued} generations are already waiting')
+
+            waiter = _Waiter(key, priority)
+            self._queues[priority].setdefault(key, deque()).append(waiter)
+            self.queued += 1
+            self.counters['waited'] += 1
+
+            try:
+                if on_queued:
+                    try:
+                        await on_queued(self.position(waiter))
+                    except Exception as e:
+                        print(f'Error sending queue notice: {e}')
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # The slot was granted just as the caller was cancelled
+                    self._release(key)
+                else:
+                    self._remove(waiter)
+                raise
+
+        waited = time.monotonic() - started
+        for hook in self.wait_hooks:
+            hook(PRIORITY_NAMES[priority], waited)
+
+        try:
+            yield
+        finally:
+            self._release(key)
+
+
+    def stats(self) -> Dict[str, int]:
+        '''Scheduler gauges and counters'''
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'queued_background': sum(len(waiters) for waiters in self._queues[BACKGROUND].values()),
+            **self.counters,
+        }
+
+
+
+scheduler = GenerationScheduler()
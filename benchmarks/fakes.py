@@ -0,0 +1,146 @@
+'''
+Offline stand-ins shared by the benchmarks: a Telegram session that records
+outgoing calls, a deterministic chat model and synthetic updates
+'''
+import json
+import time
+import asyncio
+import itertools
+from datetime import datetime
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+
+BOT_TOKEN = '42:BENCHMARK'
+
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'sendDocument'}
+
+
+
+class FakeSession(BaseSession):
+    def __init__(self, latency: float = 0.0):
+        '''
+        Bot session that answers every request locally
+
+        Responses go through the regular aiogram deserialization, so returned
+        messages are bound to the bot like real ones.
+
+        :param latency: simulated Bot API round trip in seconds
+        '''
+        super().__init__()
+        self.latency = latency
+        self.calls: List[tuple] = []
+        self._message_ids = itertools.count(1)
+
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls.append((method.__api_method__, time.perf_counter()))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method.__api_method__ == 'getMe':
+            result = {'id': bot.id, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method.__api_method__ in MESSAGE_METHODS:
+            chat_id = getattr(method, 'chat_id', None) or 1
+            result = {
+                'message_id': getattr(method, 'message_id', None) or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': getattr(method, 'text', None) or '',
+            }
+        else:
+            result = True
+
+        response = self.check_response(bot, method, 200, json.dumps({'ok': True, 'result': result}))
+        return response.result
+
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b''
+
+
+    async def close(self) -> None:
+        pass
+
+
+
+class StubChatModel(BaseChatModel):
+    '''Deterministic chat model that answers after a fixed delay'''
+
+    reply: str = 'The Trailblazer nods and the train hums softly. ' * 8
+    latency: float = 0.0
+    chunk_size: int = 64
+
+    @property
+    def _llm_type(self) -> str:
+        return 'stub'
+
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._generate(messages)
+
+
+    async def _astream(self, messages: List[BaseMessage], stop=None, run_manager=None,
+                       **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for start in range(0, len(self.reply), self.chunk_size):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=self.reply[start:start + self.chunk_size]))
+
+
+
+''' Synthetic updates '''
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User', 'last_name': str(user_id)}
+
+
+def message_update(user_id: int, text: str) -> Update:
+    '''Private text message from a user'''
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(datetime.now().timestamp()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return Update.model_validate({'update_id': next(_update_ids), 'message': message})
+
+
+def callback_update(user_id: int, data: str) -> Update:
+    '''Inline button press on a bot message'''
+    return Update.model_validate({
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': _user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': next(_update_ids),
+                'date': int(datetime.now().timestamp()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'Select an option:',
+            },
+        },
+    })
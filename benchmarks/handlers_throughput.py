@@ -0,0 +1,169 @@
+'''
+End-to-end handler throughput with a fake Telegram feed and a stub model
+
+Synthetic updates go through Dispatcher.feed_update with the real router, a
+temporary SQLite database and a bot session that answers locally. Results
+are printed to stdout as JSON, everything else the bot prints goes to stderr.
+
+Usage:
+    python -m benchmarks.handlers_throughput --users 200 --concurrency 50 --llm-latency 0.05
+'''
+import os
+import tempfile
+
+_directory = tempfile.mkdtemp(prefix='rolebot-bench-')
+os.environ['DATABASE_URL'] = f"sqlite+aiosqlite:///{os.path.join(_directory, 'bench.sqlite3')}"
+os.environ['SESSION_ARCHIVE_PATH'] = os.path.join(_directory, 'sessions.sqlite3')
+os.environ.setdefault('FSM_STORAGE', 'memory')
+os.environ.setdefault('MESSAGE_DEBOUNCE', '0')
+
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import contextlib
+import statistics
+from typing import Callable, Dict, List
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+import bot.database.requests as rq
+from bot.database.models import async_main, engine
+from bot.handlers import router
+from bot.sessions import sessions
+from bot.storage import create_storage
+from benchmarks.fakes import BOT_TOKEN, FakeSession, StubChatModel, callback_update, message_update
+from LLM.pool import client_pool
+
+
+
+def summarize(name: str, latencies: List[float], errors: int, elapsed: float, calls: int) -> Dict:
+    '''Throughput and latency percentiles of one phase'''
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'handler': name,
+        'updates': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(quantiles[49] * 1000, 2),
+        'p95_ms': round(quantiles[94] * 1000, 2),
+        'p99_ms': round(quantiles[98] * 1000, 2),
+        'bot_api_calls': calls,
+    }
+
+
+
+async def run_phase(name: str, dp: Dispatcher, bot: Bot, session: FakeSession,
+                    updates: List[Update], concurrency: int) -> Dict:
+    '''Feed updates with bounded concurrency and time every one of them'''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+    calls_before = len(session.calls)
+
+    async def feed(update: Update):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(update) for update in updates))
+    elapsed = time.perf_counter() - started
+
+    return summarize(name, latencies, errors, elapsed, len(session.calls) - calls_before)
+
+
+
+async def main() -> str:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5, help='updates per user in every phase')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--llm-latency', type=float, default=0.0, help='stub model delay in seconds')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='fake Bot API delay in seconds')
+    parser.add_argument('--output', help='also write results to this file')
+    args = parser.parse_args()
+
+    client_pool.factory = lambda api_key, model, temperature: StubChatModel(latency=args.llm_latency)
+    client_pool.clear()
+
+    session = FakeSession(latency=args.api_latency)
+    bot = Bot(BOT_TOKEN, session=session)
+    dp = Dispatcher(storage=create_storage())
+    dp.include_router(router)
+    await async_main()
+
+    users = list(range(1000, 1000 + args.users))
+
+    def repeat(build: Callable[[int], Update]) -> List[Update]:
+        return [build(user_id) for _ in range(args.rounds) for user_id in users]
+
+    # Concurrent /start of one new user races on the unique tg_id, so new users start once each
+    results = [await run_phase(
+        '/start: new user', dp, bot, session,
+        [message_update(user_id, '/start') for user_id in users], args.concurrency)]
+    results.append(await run_phase(
+        '/start: known user', dp, bot, session,
+        repeat(lambda u: message_update(u, '/start')), args.concurrency))
+
+    # Give every user a key, a character and a persona without going through the API key check
+    selections = {}
+    for user_id in users:
+        await rq.set_api(user_id, f'bench-key-{user_id}')
+        await rq.set_character(user_id, f'Character {user_id}', 'A calm conductor of the Astral Express.')
+        await rq.set_persona(user_id, f'Persona {user_id}', 'A curious Trailblazer.')
+        key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+        await dp.storage.set_state(key, None)
+        character = (await rq.get_characters_page(user_id))['items'][0]
+        persona = (await rq.get_personas_page(user_id))['items'][0]
+        selections[user_id] = (character['id'], persona['id'])
+
+    results.append(await run_phase(
+        'menu: Change_Character', dp, bot, session,
+        repeat(lambda u: callback_update(u, 'Change_Character')), args.concurrency))
+    results.append(await run_phase(
+        'menu: select_char', dp, bot, session,
+        repeat(lambda u: callback_update(u, f'select_char_{selections[u][0]}')), args.concurrency))
+    results.append(await run_phase(
+        'menu: select_persona', dp, bot, session,
+        repeat(lambda u: callback_update(u, f'select_persona_{selections[u][1]}')), args.concurrency))
+    results.append(await run_phase(
+        'handle_message', dp, bot, session,
+        repeat(lambda u: message_update(u, 'Good morning, how was the night on the train?')), args.concurrency))
+
+    report = {
+        'users': args.users,
+        'rounds': args.rounds,
+        'concurrency': args.concurrency,
+        'llm_latency': args.llm_latency,
+        'api_latency': args.api_latency,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+
+    await dp.storage.close()
+    await sessions.close()
+    await engine.dispose()
+    shutil.rmtree(_directory, ignore_errors=True)
+    return output
+
+
+
+if __name__ == '__main__':
+    # Keep stdout parseable, migrations and handlers print diagnostics
+    with contextlib.redirect_stdout(sys.stderr):
+        output = asyncio.run(main())
+    print(output)
@@ -0,0 +1,229 @@
+'''
+Memory soak test of long conversations with a stub model
+
+Many users hold long conversations through handle_message with the real
+router, a temporary SQLite database and no network. RSS and tracemalloc are
+sampled every few turns, and the report gives bytes per session, bytes per
+turn and the allocation sites that grew the most, as JSON on stdout. Everything
+else the bot prints goes to stderr.
+
+With --max-session-bytes or --max-turn-bytes the exit code is 1 when the
+measured growth exceeds the limit, so the script can gate regressions.
+
+Usage:
+    python -m benchmarks.memory_soak --users 1000 --turns 60 --sample-every 10
+'''
+import os
+import tempfile
+
+_directory = tempfile.mkdtemp(prefix='rolebot-soak-')
+os.environ['DATABASE_URL'] = f"sqlite+aiosqlite:///{os.path.join(_directory, 'soak.sqlite3')}"
+os.environ['SESSION_ARCHIVE_PATH'] = os.path.join(_directory, 'sessions.sqlite3')
+os.environ.setdefault('FSM_STORAGE', 'memory')
+os.environ.setdefault('MESSAGE_DEBOUNCE', '0')
+
+import gc
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import contextlib
+import resource
+import tracemalloc
+from typing import Dict, List, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+import bot.database.requests as rq
+from bot.database.models import async_main, engine
+from bot.handlers import router
+from bot.sessions import sessions
+from bot.storage import create_storage
+from benchmarks.fakes import BOT_TOKEN, FakeSession, StubChatModel, callback_update, message_update
+from LLM.pool import client_pool
+
+
+
+def rss_bytes() -> int:
+    '''Resident set size, or peak RSS where /proc is not available'''
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+
+async def feed_all(dp: Dispatcher, bot: Bot, updates: List[Update], concurrency: int) -> int:
+    '''Feed updates with bounded concurrency and count failures'''
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async def feed(update: Update):
+        nonlocal errors
+        async with semaphore:
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(*(feed(update) for update in updates))
+    return errors
+
+
+
+def take_sample(turn: int, elapsed: float) -> Dict:
+    '''Memory and session counters after a full collection'''
+    gc.collect()
+    traced, _ = tracemalloc.get_traced_memory()
+    chats = [entry.chat for entry in sessions._chats.values()]
+    return {
+        'turn': turn,
+        'seconds': round(elapsed, 2),
+        'rss_bytes': rss_bytes(),
+        'traced_bytes': traced,
+        'live_chats': len(chats),
+        'history_messages': sum(len(chat.chat_history) for chat in chats),
+        'history_tokens': sum(chat.chat_history.total for chat in chats),
+        'summaries': sum(1 for chat in chats if chat.chat_history.summary),
+    }
+
+
+
+def top_sites(snapshot: tracemalloc.Snapshot, baseline: tracemalloc.Snapshot, limit: int) -> List[Dict]:
+    '''Allocation sites that grew the most since the baseline'''
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    ]
+    group = 'traceback' if tracemalloc.get_traceback_limit() > 1 else 'lineno'
+    stats = snapshot.filter_traces(filters).compare_to(baseline.filter_traces(filters), group)
+    return [
+        {
+            'site': [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback],
+            'size_diff': stat.size_diff,
+            'count_diff': stat.count_diff,
+        }
+        for stat in stats[:limit]
+    ]
+
+
+
+async def main() -> Tuple[str, int]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--turns', type=int, default=60, help='messages per user')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--sample-every', type=int, default=10, help='turns between samples')
+    parser.add_argument('--frames', type=int, default=1, help='tracemalloc frames kept per allocation')
+    parser.add_argument('--top', type=int, default=15, help='allocation sites to report')
+    parser.add_argument('--max-session-bytes', type=float, help='fail above this many bytes per session')
+    parser.add_argument('--max-turn-bytes', type=float, help='fail above this many bytes per turn')
+    parser.add_argument('--output', help='also write results to this file')
+    args = parser.parse_args()
+
+    client_pool.factory = lambda api_key, model, temperature: StubChatModel()
+    client_pool.clear()
+
+    session = FakeSession()
+    bot = Bot(BOT_TOKEN, session=session)
+    dp = Dispatcher(storage=create_storage())
+    dp.include_router(router)
+    await async_main()
+
+    users = list(range(1000, 1000 + args.users))
+
+    # Register every user with a key, a character and a persona
+    selections = []
+    for user_id in users:
+        await feed_all(dp, bot, [message_update(user_id, '/start')], 1)
+        await rq.set_api(user_id, f'soak-key-{user_id}')
+        await rq.set_character(user_id, f'Character {user_id}', 'A calm conductor of the Astral Express.')
+        await rq.set_persona(user_id, f'Persona {user_id}', 'A curious Trailblazer.')
+        await dp.storage.set_state(StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id), None)
+        character = (await rq.get_characters_page(user_id))['items'][0]
+        persona = (await rq.get_personas_page(user_id))['items'][0]
+        selections.append((user_id, character['id'], persona['id']))
+
+    # Outgoing calls are not what is measured
+    session.calls.clear()
+
+    tracemalloc.start(args.frames)
+    started = time.perf_counter()
+    samples = [take_sample(0, 0.0)]
+    baseline = tracemalloc.take_snapshot()
+    errors = 0
+
+    # Selecting both builds the chat in a background warm-up, so sessions are created from here on
+    for user_id, character_id, persona_id in selections:
+        errors += await feed_all(dp, bot, [
+            callback_update(user_id, f'select_char_{character_id}'),
+            callback_update(user_id, f'select_persona_{persona_id}'),
+        ], 1)
+    await asyncio.gather(*(task for task, _ in list(sessions._prewarms.values())), return_exceptions=True)
+    session.calls.clear()
+
+    for turn in range(1, args.turns + 1):
+        errors += await feed_all(dp, bot, [
+            message_update(user_id, f'Turn {turn}: the Trailblazer looks out of the window and asks about the next stop.')
+            for user_id in users
+        ], args.concurrency)
+        session.calls.clear()
+
+        if turn == 1 or turn % args.sample_every == 0 or turn == args.turns:
+            samples.append(take_sample(turn, time.perf_counter() - started))
+            print(json.dumps(samples[-1]), file=sys.stderr)
+
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # Selection and the first turn create the sessions, the rest only grows them
+    first, last = samples[1], samples[-1]
+    later_turns = (last['turn'] - first['turn']) * args.users
+    per_session = (first['traced_bytes'] - samples[0]['traced_bytes']) / args.users
+    per_turn = (last['traced_bytes'] - first['traced_bytes']) / later_turns if later_turns else 0.0
+
+    report = {
+        'users': args.users,
+        'turns': args.turns,
+        'concurrency': args.concurrency,
+        'errors': errors,
+        'bytes_per_session': round(per_session),
+        'bytes_per_turn': round(per_turn, 1),
+        'rss_growth_bytes': last['rss_bytes'] - samples[0]['rss_bytes'],
+        'samples': samples,
+        'top_allocations': top_sites(snapshot, baseline, args.top),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+
+    await dp.storage.close()
+    await sessions.close()
+    await engine.dispose()
+    shutil.rmtree(_directory, ignore_errors=True)
+
+    failed = False
+    if args.max_session_bytes is not None and per_session > args.max_session_bytes:
+        print(f'bytes per session {per_session:.0f} > {args.max_session_bytes:.0f}', file=sys.stderr)
+        failed = True
+    if args.max_turn_bytes is not None and per_turn > args.max_turn_bytes:
+        print(f'bytes per turn {per_turn:.1f} > {args.max_turn_bytes:.1f}', file=sys.stderr)
+        failed = True
+    return output, 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    # Keep stdout parseable, migrations and handlers print diagnostics
+    with contextlib.redirect_stdout(sys.stderr):
+        output, code = asyncio.run(main())
+    print(output)
+    sys.exit(code)
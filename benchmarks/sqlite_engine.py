@@ -0,0 +1,98 @@
+'''
+Concurrent read/write throughput of the default and tuned SQLite engine profiles
+
+Usage:
+    python -m benchmarks.sqlite_engine --workers 32 --duration 10 --write-ratio 0.2
+'''
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from bot.database.models import Base, Character, User, build_engine
+
+
+
+USERS = 100
+PROMPT = 'You are a character from the Astral Express. ' * 20
+
+
+
+async def run_profile(profile: str, workers: int, duration: float, write_ratio: float) -> dict:
+    '''
+    Hammer a fresh database with concurrent readers and writers
+
+    :param profile: engine profile, 'default' or 'tuned'
+    :param workers: number of concurrent tasks
+    :param duration: seconds to run
+    :param write_ratio: share of operations that insert a character
+    :return: operation counts and throughput
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        engine = build_engine(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.sqlite3')}", profile)
+        session_factory = async_sessionmaker(engine)
+
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(insert(User), [{'tg_id': tg_id} for tg_id in range(1, USERS + 1)])
+
+        counters = {'reads': 0, 'writes': 0, 'errors': 0}
+        deadline = time.monotonic() + duration
+
+        async def worker(seed: int):
+            rnd = random.Random(seed)
+            while time.monotonic() < deadline:
+                owner_id = rnd.randint(1, USERS)
+                try:
+                    async with session_factory() as session:
+                        if rnd.random() < write_ratio:
+                            session.add(Character(name=f'character {seed}', prompt=PROMPT, owner_id=owner_id))
+                            await session.commit()
+                            counters['writes'] += 1
+                        else:
+                            result = await session.execute(
+                                select(Character.id, Character.name).where(Character.owner_id == owner_id)
+                            )
+                            result.all()
+                            counters['reads'] += 1
+                except Exception:
+                    counters['errors'] += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker(seed) for seed in range(workers)))
+        elapsed = time.monotonic() - started
+        await engine.dispose()
+
+    return {
+        'profile': profile,
+        **counters,
+        'seconds': round(elapsed, 2),
+        'ops_per_sec': round((counters['reads'] + counters['writes']) / elapsed, 1),
+        'writes_per_sec': round(counters['writes'] / elapsed, 1),
+    }
+
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = [
+        await run_profile(profile, args.workers, args.duration, args.write_ratio)
+        for profile in ('default', 'tuned')
+    ]
+    print(json.dumps(results, indent=2))
+
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
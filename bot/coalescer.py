@@ -0,0 +1,62 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, List, Optional
+
+
+
+MESSAGE_DEBOUNCE = float(os.getenv('MESSAGE_DEBOUNCE', '0.5'))
+
+
+
+class MessageCoalescer:
+    def __init__(self, window: float = MESSAGE_DEBOUNCE):
+        '''
+        Per-chat ordering and merging of user messages
+
+        Turns of one chat run one at a time, in arrival order. Messages that
+        arrive while a turn is pending or generating are merged into the next
+        turn, which waits for a short debounce window before it starts.
+
+        :param window: seconds to wait for more messages before a turn starts
+        '''
+        self.window = window
+        self._pending: Dict[Hashable, List[str]] = {}
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+
+
+    @asynccontextmanager
+    async def turn(self, key: Hashable, text: str) -> AsyncIterator[Optional[str]]:
+        '''
+        Join the next turn of a chat
+
+        :param key: chat key
+        :param text: message text
+        :return: merged text of the turn to answer, or None if the message was merged into another turn
+        '''
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.append(text)
+            yield None
+            return
+
+        pending = self._pending[key] = [text]
+        lock = self._locks.setdefault(key, asyncio.Lock())
+
+        try:
+            async with lock:
+                if self.window:
+                    await asyncio.sleep(self.window)
+                # Messages from now on belong to the next turn
+                del self._pending[key]
+                yield '\n'.join(pending)
+        finally:
+            # Cancelled before the turn started
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+            if key not in self._pending and not lock.locked():
+                self._locks.pop(key, None)
+
+
+
+coalescer = MessageCoalescer()
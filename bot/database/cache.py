@@ -0,0 +1,50 @@
+import os
+from typing import Any, Hashable, Optional
+
+from cachetools import TTLCache
+
+
+
+LIST_CACHE_SIZE = int(os.getenv('LIST_CACHE_SIZE', '1024'))
+LIST_CACHE_TTL = float(os.getenv('LIST_CACHE_TTL', '300'))
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '10000'))
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', '300'))
+
+
+
+class UserCache:
+    def __init__(self, maxsize: int = LIST_CACHE_SIZE, ttl: float = LIST_CACHE_TTL):
+        '''
+        Per-user cache of a list and its pages
+
+        Entries of one user expire together and are dropped together by
+        invalidate, so a page never outlives the list it was cut from.
+
+        :param maxsize: maximum number of cached users
+        :param ttl: seconds entries of a user stay cached
+        '''
+        self._users: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+    def get(self, tg_id: int, key: Hashable) -> Optional[Any]:
+        entries = self._users.get(tg_id)
+        return entries.get(key) if entries else None
+
+
+    def set(self, tg_id: int, key: Hashable, value: Any):
+        entries = self._users.get(tg_id)
+        if entries is None:
+            entries = self._users[tg_id] = {}
+        entries[key] = value
+
+
+    def invalidate(self, tg_id: int):
+        self._users.pop(tg_id, None)
+
+
+
+characters_cache = UserCache()
+personas_cache = UserCache()
+
+# tg_id -> (users.id, api_key), expiring so a key changed through another worker is picked up
+identity_cache: TTLCache = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
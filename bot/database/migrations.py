@@ -0,0 +1,97 @@
+from typing import Awaitable, Callable, List, Tuple, Union
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+
+
+Step = Union[str, Callable[[AsyncConnection], Awaitable[None]]]
+
+
+
+def add_column(table: str, column: str, definition: str) -> Callable[[AsyncConnection], Awaitable[None]]:
+    '''Step adding a column unless create_all already made it (fresh database)'''
+    async def step(conn: AsyncConnection):
+        columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns(table))
+        if column not in {info['name'] for info in columns}:
+            await conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {definition}'))
+    return step
+
+
+
+async def create_catalog_search(conn: AsyncConnection):
+    '''FTS5 index over the catalog, kept in sync by triggers (SQLite only, others search with LIKE)'''
+    if conn.dialect.name != 'sqlite':
+        return
+
+    for statement in (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5("
+        "name, prompt, content='catalog_characters', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+
+        'CREATE TRIGGER IF NOT EXISTS catalog_fts_insert AFTER INSERT ON catalog_characters BEGIN '
+        'INSERT INTO catalog_fts (rowid, name, prompt) VALUES (new.id, new.name, new.prompt); END',
+
+        'CREATE TRIGGER IF NOT EXISTS catalog_fts_delete AFTER DELETE ON catalog_characters BEGIN '
+        "INSERT INTO catalog_fts (catalog_fts, rowid, name, prompt) VALUES ('delete', old.id, old.name, old.prompt); END",
+
+        'CREATE TRIGGER IF NOT EXISTS catalog_fts_update AFTER UPDATE ON catalog_characters BEGIN '
+        "INSERT INTO catalog_fts (catalog_fts, rowid, name, prompt) VALUES ('delete', old.id, old.name, old.prompt); "
+        'INSERT INTO catalog_fts (rowid, name, prompt) VALUES (new.id, new.name, new.prompt); END',
+
+        "INSERT INTO catalog_fts (catalog_fts) VALUES ('rebuild')",
+    ):
+        await conn.execute(text(statement))
+
+
+
+''' Schema migrations, applied in order. Never edit or reorder applied steps, append new ones. '''
+
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, 'owner indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_characters_owner_id ON characters (owner_id)',
+        'CREATE INDEX IF NOT EXISTS ix_personas_owner_id ON personas (owner_id)',
+    ]),
+    (2, 'owner and name indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_characters_owner_id_name ON characters (owner_id, name)',
+        'CREATE INDEX IF NOT EXISTS ix_personas_owner_id_name ON personas (owner_id, name)',
+    ]),
+    (3, 'public character catalog', [
+        add_column('characters', 'catalog_id', 'INTEGER REFERENCES catalog_characters (id)'),
+        'CREATE INDEX IF NOT EXISTS ix_characters_catalog_id ON characters (catalog_id)',
+        create_catalog_search,
+    ]),
+]
+
+
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    '''Latest applied migration, 0 for a fresh database'''
+    await conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)'))
+    version = await conn.scalar(text('SELECT MAX(version) FROM schema_version'))
+    return version or 0
+
+
+
+async def migrate(conn: AsyncConnection) -> int:
+    '''
+    Apply pending migrations
+
+    :param conn: connection inside a transaction
+    :return: schema version after migrating
+    '''
+    current = await get_schema_version(conn)
+
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+
+        for statement in statements:
+            if callable(statement):
+                await statement(conn)
+            else:
+                await conn.execute(text(statement))
+        await conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+        print(f'Applied migration {version}: {description}')
+        current = version
+
+    return current
@@ -1,11 +1,61 @@
 import os
-from sqlalchemy import BigInteger, ForeignKey, String, Text
+from sqlalchemy import BigInteger, ForeignKey, Index, String, Text, event
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncEngine, async_sessionmaker, create_async_engine
+
+from bot.database.migrations import migrate
 
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite+aiosqlite:///db.sqlite3')
 
-engine = create_async_engine(url=DATABASE_URL)
+DB_PROFILE = os.getenv('DB_PROFILE', 'tuned')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000')),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024))),
+    # Negative values are KiB, so this is a 16 MiB page cache per connection
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-16000')),
+}
+
+
+
+def build_engine(url: str = DATABASE_URL, profile: str = DB_PROFILE) -> AsyncEngine:
+    '''
+    Create the database engine
+
+    The tuned profile applies SQLITE_PRAGMAS on every new SQLite connection
+    (WAL lets readers and a writer work concurrently) and sizes the pool.
+    The default profile keeps SQLAlchemy and SQLite defaults.
+
+    :param url: database URL
+    :param profile: 'tuned' or 'default'
+    :return: async engine
+    '''
+    if profile != 'tuned':
+        return create_async_engine(url=url)
+
+    is_sqlite = url.startswith('sqlite')
+    in_memory = is_sqlite and (':memory:' in url or url.rstrip('/').endswith(':'))
+
+    kwargs = {} if in_memory else {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW}
+    engine = create_async_engine(url=url, **kwargs)
+
+    if is_sqlite:
+        @event.listens_for(engine.sync_engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in SQLITE_PRAGMAS.items():
+                cursor.execute(f'PRAGMA {pragma}={value}')
+            cursor.close()
+
+    return engine
+
+
+
+engine = build_engine()
 
 async_session = async_sessionmaker(engine)
 
@@ -30,29 +80,49 @@ class User(Base):
 class Character(Base):
 
     __tablename__ = 'characters'
+    __table_args__ = (Index('ix_characters_owner_id_name', 'owner_id', 'name'),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(100))  
     prompt: Mapped[str] = mapped_column(Text)  
     
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     owner: Mapped["User"] = relationship(back_populates="characters")
 
+    # Set for characters linked from the public catalog, their own prompt is left empty
+    catalog_id: Mapped[int | None] = mapped_column(ForeignKey("catalog_characters.id"), nullable=True, index=True)
+
 
 
 class Persona(Base):
 
     __tablename__ = 'personas'
+    __table_args__ = (Index('ix_personas_owner_id_name', 'owner_id', 'name'),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(100)) 
     prompt: Mapped[str] = mapped_column(Text)
     
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     owner: Mapped["User"] = relationship(back_populates="personas")
 
 
 
+class CatalogCharacter(Base):
+
+    __tablename__ = 'catalog_characters'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(100))
+    prompt: Mapped[str] = mapped_column(Text)
+    # sha256 of the normalized name and prompt, so every published character is stored once
+    content_hash: Mapped[str] = mapped_column(String(64), unique=True)
+
+    publisher_id: Mapped[int | None] = mapped_column(ForeignKey("users.id"), nullable=True)
+
+
+
 async def async_main():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.create_all)
+        await migrate(conn)
\ No newline at end of file
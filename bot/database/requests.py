@@ -1,12 +1,44 @@
+import os
+import re
+import hashlib
+
 from bot.database.models import async_session
-from bot.database.models import User, Character, Persona
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
-from sqlalchemy.exc import SQLAlchemyError
-from typing import Optional, List
+from bot.database.models import User, Character, Persona, CatalogCharacter
+from bot.database.cache import characters_cache, personas_cache, identity_cache
+from bot.metrics import instrument_query
+from sqlalchemy import case, delete, insert, or_, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from typing import Dict, Optional, List, Tuple
+
+
+
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '10'))
+
+# Prompt of a character, read from the catalog for linked ones
+character_prompt = case(
+    (Character.catalog_id.is_not(None), CatalogCharacter.prompt),
+    else_=Character.prompt
+).label('prompt')
+
+
+
+async def get_user_id(session: AsyncSession, tg_id: int) -> int | None:
+    '''Resolve a Telegram id to users.id, querying only on identity cache misses'''
+    identity = identity_cache.get(tg_id)
+    if identity:
+        return identity[0]
+
+    row = (await session.execute(select(User.id, User.api_key).where(User.tg_id == tg_id))).first()
+    if not row:
+        return None
+
+    identity_cache[tg_id] = (row.id, row.api_key)
+    return row.id
 
 
 
+@instrument_query
 async def set_user(tg_id: int) -> User | None:
     async with async_session() as session:
         try:
@@ -17,7 +49,8 @@ async def set_user(tg_id: int) -> User | None:
                 session.add(user)
                 await session.commit()
                 await session.refresh(user)
-            
+
+            identity_cache[tg_id] = (user.id, user.api_key)
             return user
         except Exception as e:
             print(f"Error in set_user: {e}")
@@ -28,6 +61,7 @@ async def set_user(tg_id: int) -> User | None:
 
 ''' API requests'''
 
+@instrument_query
 async def set_api(tg_id: int, api_key: str) -> User:
     async with async_session() as session:
         user = await session.scalar(select(User).where(User.tg_id == tg_id))
@@ -40,17 +74,22 @@ async def set_api(tg_id: int, api_key: str) -> User:
         
         await session.commit()
         await session.refresh(user)
+        identity_cache[tg_id] = (user.id, user.api_key)
         return user
     
 
 
+@instrument_query
 async def get_api(tg_id: int) -> str | None:
+    identity = identity_cache.get(tg_id)
+    if identity:
+        return identity[1]
+
     async with async_session() as session:
         try:
-            user = await session.scalar(
-                select(User).where(User.tg_id == tg_id)
-            )
-            return user.api_key if user else None
+            await get_user_id(session, tg_id)
+            identity = identity_cache.get(tg_id)
+            return identity[1] if identity else None
         except Exception as e:
             print(f"Error getting API key: {e}")
             return None
@@ -59,71 +98,160 @@ async def get_api(tg_id: int) -> str | None:
 ''' Character requests '''
 
 
+@instrument_query
 async def set_character(tg_id: int,  character_name: str, character_prompt: str) -> Character:
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
-        if not user:
+        user_id = await get_user_id(session, tg_id)
+        if not user_id:
             raise SQLAlchemyError
             
         character = Character(
             name=character_name,
             prompt=character_prompt,
-            owner_id=user.id)
+            owner_id=user_id)
         
         session.add(character)
         await session.commit()
+        characters_cache.invalidate(tg_id)
             
         return Character
     
     
 
+@instrument_query
 async def get_characters_list(tg_id: int) -> Optional[List[dict]]:
+    cached = characters_cache.get(tg_id, 'list')
+    if cached is not None:
+        return cached or None
+
     async with async_session() as session:
         try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return None
 
             result = await session.execute(
-                select(User)
-                .where(User.tg_id == tg_id)
-                .options(selectinload(User.characters))
+                select(Character.id, Character.name, character_prompt)
+                .outerjoin(CatalogCharacter, Character.catalog_id == CatalogCharacter.id)
+                .where(Character.owner_id == user_id)
+                .order_by(Character.id)
             )
-            user = result.scalar_one()
-                
-            if not user.characters:
-                return None
                     
-            return [
+            characters = [
                     {
                     'id': char.id,
                     'name': char.name,
                     'prompt': char.prompt,
                     }
-                    for char in user.characters]
+                    for char in result]
+            characters_cache.set(tg_id, 'list', characters)
+
+            return characters or None
         
         except Exception as e:
             print(f'Error fetching characters: {e}')
             return None
         
 
-async def delete_character(tg_id: int, character_id: int) -> bool:
+@instrument_query
+async def get_characters_page(tg_id: int, cursor: int = 0, direction: str = 'n',
+                         limit: int = PAGE_SIZE) -> Optional[dict]:
+    '''
+    Keyset page of character ids and names
+
+    :param tg_id: Telegram id of the owner
+    :param cursor: id the page starts after ('n') or ends before ('p')
+    :param direction: 'n' for the next page, 'p' for the previous one
+    :param limit: page size
+    :return: dictionary with items and prev/next cursors (None when there is no such page)
+    '''
+    cache_key = ('page', cursor, direction, limit)
+    cached = characters_cache.get(tg_id, cache_key)
+    if cached is not None:
+        return cached
+
     async with async_session() as session:
         try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return None
+
+            query = select(Character.id, Character.name).where(Character.owner_id == user_id)
+            if direction == 'p':
+                query = query.where(Character.id < cursor).order_by(Character.id.desc())
+            else:
+                query = query.where(Character.id > cursor).order_by(Character.id)
+
+            rows = (await session.execute(query.limit(limit + 1))).all()
+            more = len(rows) > limit
+            rows = rows[:limit]
+            if direction == 'p':
+                rows.reverse()
+
+            items = [{'id': row.id, 'name': row.name} for row in rows]
+            has_prev = more if direction == 'p' else cursor > 0
+            has_next = cursor > 0 if direction == 'p' else more
+
+            page = {
+                'items': items,
+                'prev': items[0]['id'] if items and has_prev else None,
+                'next': items[-1]['id'] if items and has_next else None,
+                }
+            characters_cache.set(tg_id, cache_key, page)
+
+            return page
+
+        except Exception as e:
+            print(f'Error fetching characters page: {e}')
+            return None
+
+
+@instrument_query
+async def get_character(tg_id: int, character_id: int) -> Optional[dict]:
+    async with async_session() as session:
+        try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return None
+
             result = await session.execute(
-                select(User)
-                .where(User.tg_id == tg_id)
-                .options(selectinload(User.characters))
+                select(Character.id, Character.name, character_prompt)
+                .outerjoin(CatalogCharacter, Character.catalog_id == CatalogCharacter.id)
+                .where(Character.id == character_id, Character.owner_id == user_id)
             )
-            user = result.scalar_one()
-            
-            character_to_delete = next(
-                (char for char in user.characters if char.id == character_id), 
-                None
+            row = result.first()
+            if not row:
+                return None
+
+            return {
+                'id': row.id,
+                'name': row.name,
+                'prompt': row.prompt,
+                }
+
+        except Exception as e:
+            print(f'Error fetching character: {e}')
+            return None
+        
+
+@instrument_query
+async def delete_character(tg_id: int, character_id: int) -> bool:
+    async with async_session() as session:
+        try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return False
+
+            result = await session.execute(
+                delete(Character)
+                .where(Character.id == character_id, Character.owner_id == user_id)
             )
+            await session.commit()
             
-            if not character_to_delete:
+            if not result.rowcount:
                 return False
-                
-            await session.delete(character_to_delete)
-            await session.commit()
+
+            characters_cache.invalidate(tg_id)
             return True
             
         except Exception as e:
@@ -138,75 +266,367 @@ async def delete_character(tg_id: int, character_id: int) -> bool:
     
 
 
+@instrument_query
 async def set_persona(tg_id: int,  persona_name: str, persona_prompt: str) -> Persona:
     async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
-        if not user:
+        user_id = await get_user_id(session, tg_id)
+        if not user_id:
             raise SQLAlchemyError
             
         persona = Persona(
             name=persona_name,
             prompt=persona_prompt,
-            owner_id=user.id)
+            owner_id=user_id)
         
         session.add(persona)
         await session.commit()
+        personas_cache.invalidate(tg_id)
             
         return Persona
     
     
 
+@instrument_query
 async def get_personas_list(tg_id: int) -> Optional[List[dict]]:
+    cached = personas_cache.get(tg_id, 'list')
+    if cached is not None:
+        return cached or None
+
     async with async_session() as session:
         try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return None
 
-            result = await session.execute(
-                select(User)
-                .where(User.tg_id == tg_id)
-                .options(selectinload(User.personas))
+            result = await session.scalars(
+                select(Persona)
+                .where(Persona.owner_id == user_id)
+                .order_by(Persona.id)
             )
-            user = result.scalar_one()
-                
-            if not user.personas:
-                return None
                     
-            return [
+            personas = [
                     {
                     'id': char.id,
                     'name': char.name,
                     'prompt': char.prompt,
                     }
-                    for char in user.personas]
+                    for char in result]
+            personas_cache.set(tg_id, 'list', personas)
+
+            return personas or None
         
         except Exception as e:
             print(f'Error fetching personas: {e}')
             return None
         
 
-async def delete_persona(tg_id: int, persona_id: int) -> bool:
+@instrument_query
+async def get_personas_page(tg_id: int, cursor: int = 0, direction: str = 'n',
+                         limit: int = PAGE_SIZE) -> Optional[dict]:
+    '''
+    Keyset page of persona ids and names
+
+    :param tg_id: Telegram id of the owner
+    :param cursor: id the page starts after ('n') or ends before ('p')
+    :param direction: 'n' for the next page, 'p' for the previous one
+    :param limit: page size
+    :return: dictionary with items and prev/next cursors (None when there is no such page)
+    '''
+    cache_key = ('page', cursor, direction, limit)
+    cached = personas_cache.get(tg_id, cache_key)
+    if cached is not None:
+        return cached
+
+    async with async_session() as session:
+        try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return None
+
+            query = select(Persona.id, Persona.name).where(Persona.owner_id == user_id)
+            if direction == 'p':
+                query = query.where(Persona.id < cursor).order_by(Persona.id.desc())
+            else:
+                query = query.where(Persona.id > cursor).order_by(Persona.id)
+
+            rows = (await session.execute(query.limit(limit + 1))).all()
+            more = len(rows) > limit
+            rows = rows[:limit]
+            if direction == 'p':
+                rows.reverse()
+
+            items = [{'id': row.id, 'name': row.name} for row in rows]
+            has_prev = more if direction == 'p' else cursor > 0
+            has_next = cursor > 0 if direction == 'p' else more
+
+            page = {
+                'items': items,
+                'prev': items[0]['id'] if items and has_prev else None,
+                'next': items[-1]['id'] if items and has_next else None,
+                }
+            personas_cache.set(tg_id, cache_key, page)
+
+            return page
+
+        except Exception as e:
+            print(f'Error fetching personas page: {e}')
+            return None
+
+
+@instrument_query
+async def get_persona(tg_id: int, persona_id: int) -> Optional[dict]:
     async with async_session() as session:
         try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return None
+
             result = await session.execute(
-                select(User)
-                .where(User.tg_id == tg_id)
-                .options(selectinload(User.personas))
+                select(Persona.id, Persona.name, Persona.prompt)
+                .where(Persona.id == persona_id, Persona.owner_id == user_id)
             )
-            user = result.scalar_one()
-            
-            persona_to_delete = next(
-                (char for char in user.personas if char.id == persona_id), 
-                None
+            row = result.first()
+            if not row:
+                return None
+
+            return {
+                'id': row.id,
+                'name': row.name,
+                'prompt': row.prompt,
+                }
+
+        except Exception as e:
+            print(f'Error fetching persona: {e}')
+            return None
+        
+
+@instrument_query
+async def delete_persona(tg_id: int, persona_id: int) -> bool:
+    async with async_session() as session:
+        try:
+            user_id = await get_user_id(session, tg_id)
+            if not user_id:
+                return False
+
+            result = await session.execute(
+                delete(Persona)
+                .where(Persona.id == persona_id, Persona.owner_id == user_id)
             )
+            await session.commit()
             
-            if not persona_to_delete:
+            if not result.rowcount:
                 return False
-                
-            await session.delete(persona_to_delete)
-            await session.commit()
+
+            personas_cache.invalidate(tg_id)
             return True
             
         except Exception as e:
             print(f"Error deleting persona: {e}")
             await session.rollback()
             return False
-   
\ No newline at end of file
+
+
+
+''' Bulk import '''
+
+
+@instrument_query
+async def import_library(tg_id: int, characters: List[dict], personas: List[dict]) -> Dict[str, int]:
+    '''
+    Add characters and personas in one transaction
+
+    Entries equal to an existing one (same name and prompt) are skipped. Each
+    table gets a single multi-row insert.
+
+    :param characters: dictionaries with name and prompt
+    :param personas: dictionaries with name and prompt
+    :return: number of added characters and personas
+    '''
+    async with async_session() as session:
+        user_id = await get_user_id(session, tg_id)
+        if not user_id:
+            raise SQLAlchemyError
+
+        added = {}
+        for kind, model, items in (('characters', Character, characters), ('personas', Persona, personas)):
+            query = select(model.name, model.prompt).where(model.owner_id == user_id)
+            if model is Character:
+                query = (select(Character.name, character_prompt)
+                         .outerjoin(CatalogCharacter, Character.catalog_id == CatalogCharacter.id)
+                         .where(Character.owner_id == user_id))
+            existing = set(tuple(row) for row in (await session.execute(query)).all())
+
+            rows = []
+            for item in items:
+                key = (item['name'], item['prompt'])
+                if key not in existing:
+                    existing.add(key)
+                    rows.append({'name': item['name'], 'prompt': item['prompt'], 'owner_id': user_id})
+
+            if rows:
+                await session.execute(insert(model), rows)
+            added[kind] = len(rows)
+
+        await session.commit()
+
+    if added['characters']:
+        characters_cache.invalidate(tg_id)
+    if added['personas']:
+        personas_cache.invalidate(tg_id)
+    return added
+
+
+
+''' Catalog requests '''
+
+
+def catalog_hash(name: str, prompt: str) -> str:
+    '''Content hash of a character, ignoring case of the name and whitespace'''
+    content = f"{name.strip().lower()}\0{' '.join(prompt.split())}"
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+
+def catalog_match(query: str) -> str:
+    '''FTS5 query matching every word of a user query as a prefix'''
+    words = re.findall(r'\w+', query)
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+
+@instrument_query
+async def publish_character(tg_id: int, character_id: int) -> Optional[int]:
+    '''
+    Publish a character to the catalog
+
+    An equal character already in the catalog is reused. The user's own
+    character becomes a link to the catalog entry, so its prompt is stored once.
+
+    :return: catalog id, None if the character does not exist
+    '''
+    async with async_session() as session:
+        user_id = await get_user_id(session, tg_id)
+        if not user_id:
+            return None
+
+        character = await session.scalar(
+            select(Character).where(Character.id == character_id, Character.owner_id == user_id)
+        )
+        if not character:
+            return None
+        if character.catalog_id:
+            return character.catalog_id
+
+        content_hash = catalog_hash(character.name, character.prompt)
+        catalog_id = await session.scalar(
+            select(CatalogCharacter.id).where(CatalogCharacter.content_hash == content_hash)
+        )
+        if catalog_id is None:
+            try:
+                async with session.begin_nested():
+                    entry = CatalogCharacter(
+                        name=character.name,
+                        prompt=character.prompt,
+                        content_hash=content_hash,
+                        publisher_id=user_id)
+                    session.add(entry)
+                catalog_id = entry.id
+            except IntegrityError:
+                # Published by someone else at the same moment
+                catalog_id = await session.scalar(
+                    select(CatalogCharacter.id).where(CatalogCharacter.content_hash == content_hash)
+                )
+
+        character.catalog_id = catalog_id
+        character.prompt = ''
+        await session.commit()
+        characters_cache.invalidate(tg_id)
+
+        return catalog_id
+
+
+
+@instrument_query
+async def search_catalog(query: str, page: int = 0, limit: int = PAGE_SIZE) -> Optional[dict]:
+    '''
+    Page of catalog entries matching a query, best matches first
+
+    An empty query lists the newest entries.
+
+    :param query: words to look for in names and descriptions
+    :param page: page number, starting from 0
+    :param limit: page size
+    :return: dictionary with items (id and name) and whether there are more pages
+    '''
+    async with async_session() as session:
+        try:
+            match = catalog_match(query)
+            if not match:
+                result = await session.execute(
+                    select(CatalogCharacter.id, CatalogCharacter.name)
+                    .order_by(CatalogCharacter.id.desc())
+                    .limit(limit + 1).offset(page * limit)
+                )
+            elif session.bind.dialect.name == 'sqlite':
+                # Name matches weigh more than description matches
+                result = await session.execute(text(
+                    'SELECT catalog_characters.id, catalog_characters.name FROM catalog_fts '
+                    'JOIN catalog_characters ON catalog_characters.id = catalog_fts.rowid '
+                    'WHERE catalog_fts MATCH :match ORDER BY bm25(catalog_fts, 10.0, 1.0) '
+                    'LIMIT :limit OFFSET :offset'
+                ), {'match': match, 'limit': limit + 1, 'offset': page * limit})
+            else:
+                conditions = [
+                    or_(CatalogCharacter.name.ilike(f'%{word}%'), CatalogCharacter.prompt.ilike(f'%{word}%'))
+                    for word in re.findall(r'\w+', query)
+                ]
+                result = await session.execute(
+                    select(CatalogCharacter.id, CatalogCharacter.name)
+                    .where(*conditions)
+                    .order_by(CatalogCharacter.id.desc())
+                    .limit(limit + 1).offset(page * limit)
+                )
+
+            rows = result.all()
+            return {
+                'items': [{'id': row.id, 'name': row.name} for row in rows[:limit]],
+                'more': len(rows) > limit,
+                }
+
+        except Exception as e:
+            print(f'Error searching catalog: {e}')
+            return None
+
+
+
+@instrument_query
+async def add_catalog_character(tg_id: int, catalog_id: int) -> Tuple[Optional[dict], bool]:
+    '''
+    Link a catalog character into the user's list
+
+    :return: (linked character with id, name and prompt, whether it was added now),
+        (None, False) if there is no such catalog entry
+    '''
+    async with async_session() as session:
+        user_id = await get_user_id(session, tg_id)
+        if not user_id:
+            raise SQLAlchemyError
+
+        entry = await session.get(CatalogCharacter, catalog_id)
+        if not entry:
+            return None, False
+
+        character_id = await session.scalar(
+            select(Character.id).where(Character.owner_id == user_id, Character.catalog_id == catalog_id)
+        )
+        linked = {'id': character_id, 'name': entry.name, 'prompt': entry.prompt}
+        added = character_id is None
+        if added:
+            character = Character(name=entry.name, prompt='', owner_id=user_id, catalog_id=catalog_id)
+            session.add(character)
+            await session.flush()
+            linked['id'] = character.id
+            await session.commit()
+            characters_cache.invalidate(tg_id)
+
+        return linked, added
@@ -1,20 +1,29 @@
-from aiogram.filters import Command, CommandStart
+import os
+
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram import F, Router
 from aiogram.fsm.context import FSMContext
 
-import google.generativeai as genai
-
 import bot.keyboards as kb
 import bot.states as states
 import bot.database.requests as rq 
-from LLM.llm import LLMChat
+from bot.coalescer import coalescer
+from bot.library import IMPORT_MAX_BYTES, build_export, parse_import
+from bot.metrics import MetricsMiddleware
+from bot.sessions import sessions
+from bot.streaming import stream_answer
+from LLM.keys import validate_api_key
+from LLM.prompts import prompt_cache
 
-from aiogram.types import (InlineKeyboardMarkup, InlineKeyboardButton,
-                           Message, CallbackQuery)
+from aiogram.types import Message, CallbackQuery, BufferedInputFile
 
 
 
 router = Router()
+router.message.middleware(MetricsMiddleware())
+router.callback_query.middleware(MetricsMiddleware())
+
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'false').lower() == 'true'
 
 
 
@@ -57,15 +66,7 @@ async def cmd_start(message: Message, state: FSMContext):
 ''' API-key check'''
 
 async def test_gemini_api(api_key: str) -> bool:
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        await model.generate_content_async('Test', request_options={'timeout': 5})
-        return True
-    
-    except Exception as e:
-        print(f'API validation failed: {e}')
-        return False
+    return await validate_api_key(api_key)
     
 
 @router.message(states.RegAPI.api_key)
@@ -119,16 +120,8 @@ async def not_change_char_persona(callback: CallbackQuery, state: FSMContext):
     active_character = data.get('active_character')
 
     if active_persona and active_character:
-        active_persona = data.get('active_persona')
-        active_character = data.get('active_character')
-        API_KEY = await rq.get_api(callback.from_user.id)
-        
-        new_chat = LLMChat(
-            api_key=API_KEY,
-            active_character=active_character,
-            active_persona=active_persona
-        )
-        await state.update_data(llm_chat=new_chat)
+        await sessions.reset(state)
+        sessions.prewarm(state, await state.get_data(), callback.from_user.id)
         
         await callback.message.edit_text('You may now start a fresh chat.')
     
@@ -214,6 +207,53 @@ async def process_character_prompt(message: Message, state: FSMContext):
 
 
 
+''' Character pages '''
+
+
+CHARACTER_MENUS = {
+    's': ('Select a character:', 'select_char_', '', 'It seems you have not created any characters yet. Please, proceed with creating one.'),
+    'd': ('Select character to delete:', 'delete_char_', '❌ ', 'You have no characters to delete.'),
+    'p': ('Select a character to publish:', 'publish_char_', '🌐 ', 'You have no characters to publish.'),
+}
+
+
+async def show_characters_page(callback: CallbackQuery, mode: str, direction: str = 'n', cursor: int = 0):
+    '''
+    Show one page of the character select ('s'), delete ('d') or publish ('p') menu
+
+    Page buttons carry 'charpg:<mode>:<direction>:<cursor>' as callback data.
+    '''
+    title, callback_prefix, text_prefix, empty_text = CHARACTER_MENUS[mode]
+    # Pages are cached by rq, a keyboard is cheap to build from one
+    page = await rq.get_characters_page(callback.from_user.id, cursor, direction)
+
+    if not page or not page['items']:
+        if cursor:
+            await show_characters_page(callback, mode)
+        else:
+            await callback.message.edit_text(empty_text)
+        return
+
+    keyboard = kb.items_keyboard(
+        page['items'], callback_prefix, text_prefix,
+        prev_data=f"charpg:{mode}:p:{page['prev']}" if page['prev'] else None,
+        next_data=f"charpg:{mode}:n:{page['next']}" if page['next'] else None
+    )
+    await callback.message.edit_text(title, reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith('charpg:'))
+async def characters_page(callback: CallbackQuery):
+    await callback.answer()
+    try:
+        _, mode, direction, cursor = callback.data.split(':')
+        await show_characters_page(callback, mode, direction, int(cursor))
+
+    except Exception as e:
+        await callback.answer('It seems something is wrong. Please, try again later.')
+
+
+
 ''' Select Character'''
 
 
@@ -222,24 +262,7 @@ async def select_character(callback: CallbackQuery):
     await callback.answer('Change Character')
     try:
     
-        characters = await rq.get_characters_list(callback.from_user.id)
-
-        if characters is None or not characters:
-            await callback.message.edit_text('It seems you have not created any characters yet. Please, proceed with creating one.')
-            return
-        
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text=char['name'],  
-                callback_data=f"select_char_{char['id']}"  
-            )] for char in characters
-        ])
-        
-        await callback.message.edit_text(
-            'Select a character:',
-            reply_markup=keyboard
-        )
+        await show_characters_page(callback, 's')
 
     except Exception as e:
         await callback.answer('It seems something is wrong. Please, try again later.')
@@ -250,21 +273,15 @@ async def process_selected_character(callback: CallbackQuery, state: FSMContext)
     character_id = int(callback.data.split('_')[-1])
     
     try:
-        characters = await rq.get_characters_list(callback.from_user.id)
-
-        if not characters:
-            await callback.answer('It seems something is wrong. Please, try again later.')
-            return
-            
-        selected_character = next((char for char in characters if char['id'] == character_id), None)
-
+        selected_character = await rq.get_character(callback.from_user.id, character_id)
             
         if selected_character:
             await callback.message.answer(
                 f"Selected character: {selected_character['name']}\n"
                 f"Description: {selected_character['prompt'][:100]}...")
 
-            await state.update_data(active_character=selected_character)
+            data = await state.update_data(active_character=selected_character)
+            sessions.prewarm(state, data, callback.from_user.id)
             await callback.answer(f"Character '{selected_character['name']}' is now active!")
         else:
             await callback.answer('Character not found!')
@@ -281,23 +298,7 @@ async def process_selected_character(callback: CallbackQuery, state: FSMContext)
 async def delete_character_start(callback: CallbackQuery):
     await callback.answer('Delete Character')
     try:
-        characters = await rq.get_characters_list(callback.from_user.id)
-
-        if not characters or characters is None:
-            await callback.message.edit_text('You have no characters to delete.')
-            return
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"❌ {char['name']}",
-                callback_data=f"delete_char_{char['id']}"
-            )] for char in characters
-        ])
-        
-        await callback.message.edit_text(
-            'Select character to delete:',
-            reply_markup=keyboard
-        )
+        await show_characters_page(callback, 'd')
 
     except Exception as e:
         await callback.answer('It seems something is wrong. Please, try again later.', show_alert=True)
@@ -311,6 +312,7 @@ async def process_delete_character(callback: CallbackQuery):
         success = await rq.delete_character(callback.from_user.id, character_id)
         
         if success:
+            prompt_cache.invalidate_character(character_id)
             await callback.answer('Character deleted successfully!', show_alert=True)
             await delete_character_start(callback)
         else:
@@ -324,6 +326,115 @@ async def process_delete_character(callback: CallbackQuery):
 
 
 
+''' Character catalog '''
+
+
+@router.callback_query(F.data == 'Publish_Character')
+async def publish_character_start(callback: CallbackQuery):
+    await callback.answer('Publish Character')
+    try:
+        await show_characters_page(callback, 'p')
+
+    except Exception as e:
+        await callback.answer('It seems something is wrong. Please, try again later.', show_alert=True)
+
+
+@router.callback_query(F.data.startswith('publish_char_'))
+async def process_publish_character(callback: CallbackQuery):
+    character_id = int(callback.data.split('_')[-1])
+
+    try:
+        catalog_id = await rq.publish_character(callback.from_user.id, character_id)
+
+        if catalog_id:
+            await callback.answer('Character published! Everyone can now find it with /catalog.', show_alert=True)
+        else:
+            await callback.answer('Character not found!', show_alert=True)
+
+    except Exception as e:
+        await callback.answer('Error publishing character', show_alert=True)
+        print(f'Error publishing character: {e}')
+
+
+async def show_catalog_page(message: Message, query: str, page: int = 0, edit: bool = False):
+    '''
+    Show one page of catalog search results
+
+    Page buttons carry 'catpg:<page>' as callback data, the query itself is
+    kept in FSM data since callback data is limited to 64 bytes.
+    '''
+    results = await rq.search_catalog(query, page)
+
+    if results is None:
+        text, keyboard = 'It seems something is wrong. Please, try again later.', None
+    elif not results['items']:
+        text, keyboard = 'Nothing found in the catalog.' if query else 'The catalog is empty for now.', None
+    else:
+        text = f'Catalog results for "{query}":' if query else 'Newest characters in the catalog:'
+        keyboard = kb.items_keyboard(
+            results['items'], 'catalog_add_', '➕ ',
+            prev_data=f'catpg:{page - 1}' if page else None,
+            next_data=f'catpg:{page + 1}' if results['more'] else None
+        )
+
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard)
+    else:
+        await message.answer(text, reply_markup=keyboard)
+
+
+@router.message(Command('catalog'))
+async def search_catalog(message: Message, command: CommandObject, state: FSMContext):
+    query = (command.args or '').strip()
+    await state.update_data(catalog_query=query)
+    await show_catalog_page(message, query)
+
+
+@router.callback_query(F.data == 'Catalog')
+async def browse_catalog(callback: CallbackQuery, state: FSMContext):
+    await callback.answer('Catalog')
+    try:
+        await state.update_data(catalog_query='')
+        await show_catalog_page(callback.message, '', edit=True)
+
+    except Exception as e:
+        await callback.answer('It seems something is wrong. Please, try again later.')
+
+
+@router.callback_query(F.data.startswith('catpg:'))
+async def catalog_page(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+    try:
+        page = max(int(callback.data.split(':')[-1]), 0)
+        query = (await state.get_data()).get('catalog_query', '')
+        await show_catalog_page(callback.message, query, page, edit=True)
+
+    except Exception as e:
+        await callback.answer('It seems something is wrong. Please, try again later.')
+
+
+@router.callback_query(F.data.startswith('catalog_add_'))
+async def process_catalog_add(callback: CallbackQuery):
+    catalog_id = int(callback.data.split('_')[-1])
+
+    try:
+        character, added = await rq.add_catalog_character(callback.from_user.id, catalog_id)
+
+        if not character:
+            await callback.answer('This character is no longer in the catalog.', show_alert=True)
+        elif added:
+            await callback.answer(f"'{character['name']}' was added to your characters!", show_alert=True)
+        else:
+            await callback.answer(f"'{character['name']}' is already in your characters.", show_alert=True)
+
+    except Exception as e:
+        await callback.answer('Error adding character', show_alert=True)
+        print(f'Error adding catalog character: {e}')
+
+
+
+
+
 ''' Personas Options responses'''
 
 '''New Persona'''
@@ -359,6 +470,52 @@ async def process_persona_prompt(message: Message, state: FSMContext):
 
 
 
+''' Persona pages '''
+
+
+PERSONA_MENUS = {
+    's': ('Select a persona:', 'select_persona_', '', 'It seems you have not created any personas yet. Please, proceed with creating one.'),
+    'd': ('Select persona to delete:', 'delete_persona_', '❌ ', 'You have no personas to delete.'),
+}
+
+
+async def show_personas_page(callback: CallbackQuery, mode: str, direction: str = 'n', cursor: int = 0):
+    '''
+    Show one page of the persona select ('s') or delete ('d') menu
+
+    Page buttons carry 'personapg:<mode>:<direction>:<cursor>' as callback data.
+    '''
+    title, callback_prefix, text_prefix, empty_text = PERSONA_MENUS[mode]
+    # Pages are cached by rq, a keyboard is cheap to build from one
+    page = await rq.get_personas_page(callback.from_user.id, cursor, direction)
+
+    if not page or not page['items']:
+        if cursor:
+            await show_personas_page(callback, mode)
+        else:
+            await callback.message.edit_text(empty_text)
+        return
+
+    keyboard = kb.items_keyboard(
+        page['items'], callback_prefix, text_prefix,
+        prev_data=f"personapg:{mode}:p:{page['prev']}" if page['prev'] else None,
+        next_data=f"personapg:{mode}:n:{page['next']}" if page['next'] else None
+    )
+    await callback.message.edit_text(title, reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith('personapg:'))
+async def personas_page(callback: CallbackQuery):
+    await callback.answer()
+    try:
+        _, mode, direction, cursor = callback.data.split(':')
+        await show_personas_page(callback, mode, direction, int(cursor))
+
+    except Exception as e:
+        await callback.answer('It seems something is wrong. Please, try again later.')
+
+
+
 ''' Select Persona'''
 
 
@@ -367,23 +524,7 @@ async def select_persona(callback: CallbackQuery):
     await callback.answer('Change Persona')
     try:
     
-        personas = await rq.get_personas_list(callback.from_user.id)
-
-        if personas is None or not personas:
-            await callback.message.edit_text('It seems you have not created any personas yet. Please, proceed with creating one.')
-            return
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text=persona['name'],  
-                callback_data=f"select_persona_{persona['id']}"  
-            )] for persona in personas
-        ])
-        
-        await callback.message.edit_text(
-            'Select a persona:',
-            reply_markup=keyboard
-        )
+        await show_personas_page(callback, 's')
 
     except Exception as e:
         await callback.answer('It seems something is wrong. Please, try again later.')
@@ -394,20 +535,15 @@ async def process_selected_persona(callback: CallbackQuery, state: FSMContext):
     persona_id = int(callback.data.split('_')[-1])
     
     try:
-        personas = await rq.get_personas_list(callback.from_user.id)
-
-        if not personas:
-            await callback.answer('It seems something is wrong. Please, try again later.')
-            return
-            
-        selected_persona = next((persona for persona in personas if persona['id'] == persona_id), None)
+        selected_persona = await rq.get_persona(callback.from_user.id, persona_id)
         
         if selected_persona:
             await callback.message.answer(
                 f"Selected persona: {selected_persona['name']}\n"
                 f"Description: {selected_persona['prompt'][:100]}...")
 
-            await state.update_data(active_persona=selected_persona)
+            data = await state.update_data(active_persona=selected_persona)
+            sessions.prewarm(state, data, callback.from_user.id)
             await callback.answer(f"Persona '{selected_persona['name']}' is now active!")
         else:
             await callback.answer('Persona not found!')
@@ -424,23 +560,7 @@ async def process_selected_persona(callback: CallbackQuery, state: FSMContext):
 async def delete_persona_start(callback: CallbackQuery):
     await callback.answer('Delete Persona')
     try:
-        personas = await rq.get_personas_list(callback.from_user.id)
-
-        if not personas or personas is None:
-            await callback.message.edit_text('You have no personas to delete.')
-            return
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(
-                text=f"❌ {persona['name']}",
-                callback_data=f"delete_persona_{persona['id']}"
-            )] for persona in personas
-        ])
-        
-        await callback.message.edit_text(
-            'Select persona to delete:',
-            reply_markup=keyboard
-        )
+        await show_personas_page(callback, 'd')
 
     except Exception as e:
         await callback.answer('It seems something is wrong. Please, try again later.', show_alert=True)
@@ -454,6 +574,7 @@ async def process_delete_persona(callback: CallbackQuery):
         success = await rq.delete_persona(callback.from_user.id, persona_id)
         
         if success:
+            prompt_cache.invalidate_persona(persona_id)
             await callback.answer('Persona deleted successfully!', show_alert=True)
             await delete_persona_start(callback)
         else:
@@ -464,6 +585,80 @@ async def process_delete_persona(callback: CallbackQuery):
 
 
 
+''' Import and Export '''
+
+@router.message(Command('export'))
+async def export_library(message: Message):
+    try:
+        characters = await rq.get_characters_list(message.from_user.id)
+        personas = await rq.get_personas_list(message.from_user.id)
+
+        if not (characters or personas):
+            await message.answer('You have no characters or personas to export yet.')
+            return
+
+        await message.answer_document(
+            BufferedInputFile(build_export(characters, personas), filename='rolebot-library.json'),
+            caption=f'{len(characters or ())} characters and {len(personas or ())} personas. '
+                    'Send this file after /import to restore them.')
+
+    except Exception as e:
+        await message.answer('It seems something is wrong. Please, try again later.')
+        print(f'Error exporting library: {e}')
+
+
+@router.message(Command('import'))
+async def import_library_start(message: Message, state: FSMContext):
+    await message.answer('Please, send me a JSON or ZIP file with characters and personas. '
+                         'Files from /export and character cards are supported.')
+    await state.set_state(states.Library.import_file)
+
+
+@router.message(states.Library.import_file, F.document)
+async def process_import_file(message: Message, state: FSMContext):
+    await state.set_state(None)
+
+    if message.document.file_size and message.document.file_size > IMPORT_MAX_BYTES:
+        await message.answer(f'This file is too large, the limit is {IMPORT_MAX_BYTES // (1024 * 1024)} MB.')
+        return
+
+    try:
+        data = (await message.bot.download(message.document)).read()
+        valid, skipped = parse_import(data)
+    except ValueError as e:
+        await message.answer(f'I could not read this file: {e}.')
+        return
+    except Exception as e:
+        await message.answer('It seems something is wrong. Please, try again later.')
+        print(f'Error reading import file: {e}')
+        return
+
+    try:
+        added = await rq.import_library(message.from_user.id, valid['character'], valid['persona'])
+    except Exception as e:
+        await message.answer('Ah, it seems something is wrong. My apologies. Please, try again later.')
+        print(f'Error importing library: {e}')
+        return
+
+    duplicates = len(valid['character']) + len(valid['persona']) - added['characters'] - added['personas']
+    report = [f"Imported {added['characters']} characters and {added['personas']} personas."]
+    if duplicates:
+        report.append(f'{duplicates} already existed and were skipped.')
+    if skipped:
+        report.append(f'{len(skipped)} entries were skipped:')
+        report.extend(f'- {reason}' for reason in skipped[:10])
+        if len(skipped) > 10:
+            report.append(f'...and {len(skipped) - 10} more.')
+    await message.answer('\n'.join(report))
+
+
+@router.message(states.Library.import_file)
+async def process_import_other(message: Message, state: FSMContext):
+    await state.set_state(None)
+    await message.answer('Import cancelled. Use /import again and send the file as a document.')
+
+
+
 ''' Active Character/Persona check '''
 
 @router.message(Command('status'))
@@ -496,22 +691,28 @@ async def handle_message(message: Message, state: FSMContext):
     active_character = data.get('active_character')
 
     if active_persona and active_character:
+        # Stickers, photos and files are not part of the story
+        if message.text is None:
+            return
+
+        async with coalescer.turn(state.key, message.text) as text:
+            if text is None:
+                return
 
-        chat: LLMChat = data.get('llm_chat')
-        if not chat:
-            active_persona = data.get('active_persona')
-            active_character = data.get('active_character')
-            API_KEY = await rq.get_api(message.from_user.id)
+            data = await state.get_data()
+            chat = await sessions.get_chat(state, data, message.from_user.id)
         
-            chat = LLMChat(
-                api_key=API_KEY,
-                active_character=active_character,
-                active_persona=active_persona
-            )
-            await state.update_data(llm_chat=chat)
-    
-        response = await chat.get_response(message.text)
-        await message.answer(response)
+            async def notify_queued(position: int):
+                await message.answer(f'Many people are chatting right now. You are number {position} in the queue, '
+                                     'the reply will follow shortly.')
+
+            if STREAM_REPLIES:
+                await stream_answer(message, chat.stream_response(text, notify_queued))
+            else:
+                response = await chat.get_response(text, notify_queued)
+                await message.answer(response)
+
+            await sessions.save(state, chat)
           
     elif active_persona:
         await message.answer("Please, select a character first.")
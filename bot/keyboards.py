@@ -1,3 +1,5 @@
+from typing import List, Optional
+
 from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton,
                            InlineKeyboardMarkup, InlineKeyboardButton)
 
@@ -29,7 +31,9 @@ change_options_inline = InlineKeyboardMarkup(inline_keyboard=[
 characters_options_inline = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text='Select a character', callback_data='Change_Character'), 
      InlineKeyboardButton(text='Create a character', callback_data='Create_Character')],
-    [InlineKeyboardButton(text='Delete a character', callback_data='Delete_Character')]
+    [InlineKeyboardButton(text='Delete a character', callback_data='Delete_Character')],
+    [InlineKeyboardButton(text='Publish a character', callback_data='Publish_Character'),
+     InlineKeyboardButton(text='Browse catalog', callback_data='Catalog')]
 ])
 
 
@@ -37,4 +41,35 @@ personas_options_inline = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text='Select a persona', callback_data='Change_Persona'), 
      InlineKeyboardButton(text='Create a persona', callback_data='Create_Persona')],
     [InlineKeyboardButton(text='Delete a persona', callback_data='Delete_Persona')]
-])
\ No newline at end of file
+])
+
+
+
+def items_keyboard(items: List[dict], callback_prefix: str, text_prefix: str = '',
+                   prev_data: Optional[str] = None, next_data: Optional[str] = None) -> InlineKeyboardMarkup:
+    '''
+    Keyboard with one button per character or persona
+
+    :param items: dictionaries with id and name
+    :param callback_prefix: callback data prefix, the id is appended to it
+    :param text_prefix: text put before every name
+    :param prev_data: callback data of the previous page button, no button if None
+    :param next_data: callback data of the next page button, no button if None
+    :return: inline keyboard
+    '''
+    rows = [
+        [InlineKeyboardButton(
+            text=f"{text_prefix}{item['name']}",
+            callback_data=f"{callback_prefix}{item['id']}"
+        )] for item in items
+    ]
+
+    navigation = []
+    if prev_data:
+        navigation.append(InlineKeyboardButton(text='◀️', callback_data=prev_data))
+    if next_data:
+        navigation.append(InlineKeyboardButton(text='▶️', callback_data=next_data))
+    if navigation:
+        rows.append(navigation)
+
+    return InlineKeyboardMarkup(inline_keyboard=rows)
@@ -0,0 +1,152 @@
+import os
+import io
+import json
+import zipfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(5 * 1024 * 1024)))
+IMPORT_MAX_ENTRIES = int(os.getenv('IMPORT_MAX_ENTRIES', '1000'))
+
+NAME_LIMIT = 100
+PROMPT_LIMIT = 20000
+
+EXPORT_FORMAT = 'rolebot'
+EXPORT_VERSION = 1
+
+# Character card fields joined into a prompt, with their labels
+CARD_FIELDS = (('description', ''), ('personality', 'Personality: '), ('scenario', 'Scenario: '))
+
+
+
+def build_export(characters: Optional[List[dict]], personas: Optional[List[dict]]) -> bytes:
+    '''JSON document with every character and persona of a user'''
+    document = {
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_VERSION,
+        'characters': [{'name': item['name'], 'prompt': item['prompt']} for item in characters or ()],
+        'personas': [{'name': item['name'], 'prompt': item['prompt']} for item in personas or ()],
+    }
+    return json.dumps(document, ensure_ascii=False, indent=2).encode()
+
+
+
+def _documents(data: bytes) -> Iterator[Tuple[str, Any]]:
+    '''(file name, parsed JSON) of a JSON file or of every JSON file in a ZIP archive'''
+    if not zipfile.is_zipfile(io.BytesIO(data)):
+        try:
+            yield '', json.loads(data)
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f'not a JSON or ZIP file ({e})')
+        return
+
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith('.json'):
+                continue
+            # Sizes are checked before unpacking, so a small archive cannot expand without bound
+            total += info.file_size
+            if total > IMPORT_MAX_BYTES:
+                raise ValueError('archive is too large once unpacked')
+            try:
+                yield info.filename, json.loads(archive.read(info))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                yield info.filename, None
+
+
+
+def _card_prompt(card: Dict) -> str:
+    parts = []
+    for field, label in CARD_FIELDS:
+        value = card.get(field)
+        if isinstance(value, str) and value.strip():
+            parts.append(f'{label}{value.strip()}')
+    return '\n\n'.join(parts)
+
+
+
+def _entries(document: Any) -> Iterator[Tuple[str, Any]]:
+    '''(kind, raw entry) pairs of a rolebot export, a character card or a list of either'''
+    if isinstance(document, list):
+        for item in document:
+            yield from _entries(item)
+        return
+
+    if not isinstance(document, dict):
+        yield 'character', document
+        return
+
+    if document.get('format') == EXPORT_FORMAT:
+        for item in document.get('characters') or ():
+            yield 'character', item
+        for item in document.get('personas') or ():
+            yield 'persona', item
+        return
+
+    # Character card v2/v3 keeps its fields under "data", v1 at the top level
+    card = document.get('data') if isinstance(document.get('data'), dict) else document
+    if 'prompt' in card:
+        yield 'character', card
+    else:
+        yield 'character', {'name': card.get('name'), 'prompt': _card_prompt(card)}
+
+
+
+def _validate(entry: Any) -> Tuple[Optional[Dict], Optional[str]]:
+    '''(clean entry, None) or (None, reason)'''
+    if not isinstance(entry, dict):
+        return None, 'not an object'
+
+    name = entry.get('name')
+    prompt = entry.get('prompt')
+    if not isinstance(name, str) or not name.strip():
+        return None, 'no name'
+    if not isinstance(prompt, str) or not prompt.strip():
+        return None, f'"{name.strip()[:30]}" has no description'
+    if len(name.strip()) > NAME_LIMIT:
+        return None, f'"{name.strip()[:30]}..." has a name longer than {NAME_LIMIT} characters'
+    if len(prompt.strip()) > PROMPT_LIMIT:
+        return None, f'"{name.strip()[:30]}" has a description longer than {PROMPT_LIMIT} characters'
+
+    return {'name': name.strip(), 'prompt': prompt.strip()}, None
+
+
+
+def parse_import(data: bytes) -> Tuple[Dict[str, List[Dict]], List[str]]:
+    '''
+    Validate an import file in one pass
+
+    Entries are checked one at a time as they are read, and reading stops at
+    IMPORT_MAX_ENTRIES, so nothing beyond the valid entries is kept.
+
+    :param data: JSON or ZIP file contents
+    :return: valid entries by kind ('character', 'persona') and reasons of skipped ones
+    :raises ValueError: the file cannot be read at all
+    '''
+    if len(data) > IMPORT_MAX_BYTES:
+        raise ValueError('file is too large')
+
+    valid: Dict[str, List[Dict]] = {'character': [], 'persona': []}
+    skipped: List[str] = []
+    count = 0
+
+    for filename, document in _documents(data):
+        if document is None:
+            skipped.append(f'{filename} is not valid JSON')
+            continue
+
+        for kind, entry in _entries(document):
+            count += 1
+            if count > IMPORT_MAX_ENTRIES:
+                skipped.append(f'only the first {IMPORT_MAX_ENTRIES} entries are imported')
+                return valid, skipped
+
+            clean, reason = _validate(entry)
+            if clean:
+                valid[kind].append(clean)
+            else:
+                skipped.append(f'{filename}: {reason}' if filename else reason)
+
+    return valid, skipped
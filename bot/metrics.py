@@ -0,0 +1,277 @@
+import os
+import time
+import bisect
+import functools
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+
+import LLM.llm as llm
+from LLM.pool import client_pool
+from LLM.resilience import resilience
+from LLM.scheduler import scheduler
+
+
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.register(self)
+
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple:
+        return tuple(labels.get(name, '') for name in self.labels)
+
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        '''(name suffix, formatted labels, value) of every series'''
+        return ()
+
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {value}')
+        return lines
+
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self._values: Dict[Tuple, float] = {}
+        super().__init__(name, documentation, labels)
+
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield '', _format_labels(self.labels, key), value
+
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, List] = {}
+        super().__init__(name, documentation, labels)
+
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # per-bucket counts (last one is +Inf), sum
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+
+    def samples(self):
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '_bucket', _format_labels(self.labels + ('le',), key + (bound,)), cumulative
+            labels = _format_labels(self.labels, key)
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+
+class CollectedGauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Dict[str, float]],
+                 label: str = 'kind'):
+        '''
+        Gauge read from a stats() dictionary at scrape time
+
+        :param collect: returns {label value: number}
+        :param label: label name for the dictionary keys
+        '''
+        self.collect = collect
+        super().__init__(name, documentation, (label,))
+
+
+    def samples(self):
+        for key, value in self.collect().items():
+            yield '', _format_labels(self.labels, (key,)), value
+
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+
+
+    def render(self) -> str:
+        '''Text exposition format'''
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+
+registry = Registry()
+
+handler_latency = Histogram('rolebot_handler_seconds', 'Handler latency', ('handler',))
+handler_errors = Counter('rolebot_handler_errors_total', 'Handler exceptions', ('handler', 'exception'))
+
+query_latency = Histogram('rolebot_db_query_seconds', 'Database request function latency', ('query',))
+query_errors = Counter('rolebot_db_query_errors_total', 'Database request function exceptions', ('query', 'exception'))
+
+llm_latency = Histogram('rolebot_llm_call_seconds', 'Model call latency', ('kind',))
+llm_errors = Counter('rolebot_llm_errors_total', 'Model call errors', ('kind', 'exception'))
+llm_in_flight = Gauge('rolebot_llm_in_flight', 'Model calls in progress')
+llm_prompt_tokens = Histogram('rolebot_llm_prompt_tokens', 'Estimated prompt size in tokens', ('kind',), SIZE_BUCKETS)
+llm_response_chars = Histogram('rolebot_llm_response_chars', 'Response size in characters', ('kind',), SIZE_BUCKETS)
+
+client_pool_stats = CollectedGauge('rolebot_client_pool', 'Gemini client pool size and counters', client_pool.stats)
+generation_wait = Histogram('rolebot_generation_wait_seconds', 'Time a model call waited for a generation slot',
+                            ('priority',))
+scheduler_stats = CollectedGauge('rolebot_generation_scheduler', 'Running and queued generations and scheduler counters',
+                                 scheduler.stats)
+resilience_stats = CollectedGauge('rolebot_llm_resilience', 'Model call retry and circuit breaker counters', resilience.stats)
+
+
+
+''' Instrumentation '''
+
+class MetricsMiddleware(BaseMiddleware):
+    '''Inner middleware timing every handler and counting its exceptions'''
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            handler_errors.inc(handler=name, exception=type(e).__name__)
+            raise
+        finally:
+            handler_latency.observe(time.perf_counter() - started, handler=name)
+
+
+
+def instrument_query(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    '''Time a database request function and count its exceptions'''
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            query_errors.inc(query=func.__name__, exception=type(e).__name__)
+            raise
+        finally:
+            query_latency.observe(time.perf_counter() - started, query=func.__name__)
+
+    return wrapper
+
+
+
+def observe_llm_call(record: Dict[str, Any]):
+    '''LLMChat call hook'''
+    if record['event'] == 'start':
+        llm_in_flight.inc()
+        llm_prompt_tokens.observe(record['prompt_tokens'], kind=record['kind'])
+        return
+
+    llm_in_flight.dec()
+    llm_latency.observe(record['seconds'], kind=record['kind'])
+    if record.get('error'):
+        llm_errors.inc(kind=record['kind'], exception=record['error'])
+    else:
+        llm_response_chars.observe(record['response_chars'], kind=record['kind'])
+
+
+
+def observe_generation_wait(priority: str, seconds: float):
+    '''Generation scheduler wait hook'''
+    generation_wait.observe(seconds, priority=priority)
+
+
+
+llm.call_hooks.append(observe_llm_call)
+scheduler.wait_hooks.append(observe_generation_wait)
+
+
+
+''' Endpoint '''
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    '''
+    Serve /metrics on its own local port, apart from the public webhook app
+
+    :return: runner to clean up on shutdown, None if METRICS_PORT is 0
+    '''
+    if not port:
+        return None
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
@@ -0,0 +1,346 @@
+import os
+import time
+import weakref
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+import bot.database.requests as rq
+from bot.metrics import CollectedGauge
+from bot.storage import SessionArchive
+from LLM.history import ChatHistory
+from LLM.llm import LLMChat
+
+
+
+PREWARM_TIMEOUT = float(os.getenv('PREWARM_TIMEOUT', '5'))
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '1800'))
+SESSION_MAX_LIVE = int(os.getenv('SESSION_MAX_LIVE', '5000'))
+SESSION_MAX_TOKENS = int(os.getenv('SESSION_MAX_TOKENS', '10000000'))
+
+
+
+class LiveSession:
+    __slots__ = ('chat', 'version', 'epoch', 'state', 'last_used', 'restored', 'tokens')
+
+    def __init__(self, chat: LLMChat, version: int, epoch: int, state: FSMContext, restored: bool = False):
+        self.chat = chat
+        self.version = version
+        # Session the chat belongs to, every reset starts a new one
+        self.epoch = epoch
+        self.state = state
+        self.last_used = time.monotonic()
+        # History came from the archive, its row is dropped on the next save
+        self.restored = restored
+        # History tokens last counted into SessionManager's total
+        self.tokens = 0
+
+
+
+class SessionManager:
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL, max_live: int = SESSION_MAX_LIVE,
+                 max_tokens: int = SESSION_MAX_TOKENS, archive: Optional[SessionArchive] = None):
+        '''
+        Registry of live chats
+
+        FSM data only keeps a serializable session: character id, persona id,
+        an epoch, a version counter and the compact history. The LLMChat built
+        from it is kept here and rebuilt lazily when it is missing (after a
+        restart) or stale (another process answered or reset since). A reply
+        finishing after a reset belongs to the old epoch and is not saved.
+
+        Chats can be warmed up in the background once a character and a
+        persona are selected, at most one warm-up per user.
+
+        Chats unused for idle_ttl, and the least recently used ones beyond
+        max_live chats or max_tokens estimated history tokens, are dropped in
+        the background. Their history moves from FSM data into a compressed
+        archive and comes back on the next message.
+
+        :param idle_ttl: seconds a chat may stay unused before eviction
+        :param max_live: maximum number of live chats
+        :param max_tokens: maximum estimated history tokens of all live chats
+        :param archive: store of spilled histories
+        '''
+        self.idle_ttl = idle_ttl
+        self.max_live = max_live
+        self.max_tokens = max_tokens
+        self.archive = archive or SessionArchive()
+        self._chats: OrderedDict[StorageKey, LiveSession] = OrderedDict()
+        # Chats evicted while possibly answering: key -> (weak reference to the chat, epoch)
+        self._evicted: Dict[StorageKey, Tuple[weakref.ref, int]] = {}
+        self._tokens = 0
+        self._prewarms: Dict[StorageKey, Tuple[asyncio.Task, Tuple]] = {}
+        self._locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self._eviction: Optional[asyncio.Task] = None
+        self.counters = {'evictions': 0, 'spills': 0, 'restores': 0}
+
+
+    async def get_chat(self, state: FSMContext, data: Dict, tg_id: int) -> LLMChat:
+        '''
+        Get a live chat for the active character and persona
+
+        :param state: FSM context of the user
+        :param data: current FSM data
+        :param tg_id: Telegram id of the user
+        :return: chat ready to answer
+        '''
+        active_character = data['active_character']
+        active_persona = data['active_persona']
+        session = data.get('session') or {}
+        version = session.get('version', 0)
+        epoch = session.get('epoch', 0)
+        history = session.get('history')
+
+        def is_current(entry: Optional[LiveSession]) -> bool:
+            return bool(entry) and entry.version == version and entry.epoch == epoch
+
+        entry = self._chats.get(state.key)
+        if not is_current(entry):
+            API_KEY = await rq.get_api(tg_id)
+            async with self._lock(state.key):
+                # Read again under the lock, a spill may have moved the history into the archive meanwhile
+                session = (await state.get_data()).get('session') or {}
+                version = session.get('version', 0)
+                epoch = session.get('epoch', 0)
+                history = session.get('history')
+                # A warm-up may have built the same chat while the key was fetched
+                entry = self._chats.get(state.key)
+
+                if not is_current(entry):
+                    if session.get('archived'):
+                        history = await self.archive.get(state.key)
+                    chat = LLMChat(
+                        api_key=API_KEY,
+                        active_character=active_character,
+                        active_persona=active_persona
+                    )
+                    if history:
+                        chat.chat_history = ChatHistory.load(history)
+                    self._evicted.pop(state.key, None)
+                    entry = self._put(state.key, LiveSession(chat, version, epoch, state, bool(session.get('archived'))))
+                    if entry.restored:
+                        self.counters['restores'] += 1
+
+        chat = entry.chat
+        entry.last_used = time.monotonic()
+        self._chats.move_to_end(state.key)
+        self._schedule_eviction()
+
+        if chat.active_character.get('id') != active_character.get('id'):
+            await chat.update_character(active_character)
+        if chat.active_persona.get('id') != active_persona.get('id'):
+            await chat.update_persona(active_persona)
+
+        return chat
+
+
+    async def save(self, state: FSMContext, chat: LLMChat):
+        '''Write the session of a live chat back to FSM storage'''
+        async with self._lock(state.key):
+            stored = (await state.get_data()).get('session') or {}
+            entry = self._chats.get(state.key)
+            if not entry or entry.chat is not chat:
+                evicted = self._evicted.get(state.key)
+                if not evicted or evicted[0]() is not chat:
+                    # Reset or rebuilt while answering, the reply belongs to a discarded session
+                    return
+                # Evicted while answering. A spilled history is replaced below, its archive row goes with it
+                del self._evicted[state.key]
+                entry = self._put(state.key, LiveSession(chat, stored.get('version', 0), evicted[1], state,
+                                                         bool(stored.get('archived'))))
+
+            if entry.epoch != stored.get('epoch', 0):
+                # Reset by another process while answering
+                self._drop(state.key)
+                return
+
+            entry.version += 1
+            entry.last_used = time.monotonic()
+            self._chats.move_to_end(state.key)
+            self._count(entry)
+
+            await state.update_data(session={
+                'character_id': chat.active_character.get('id'),
+                'persona_id': chat.active_persona.get('id'),
+                'epoch': entry.epoch,
+                'version': entry.version,
+                'history': chat.chat_history.dump(),
+            })
+
+            # The stored flag also covers a spill that raced with this chat being built
+            if entry.restored or stored.get('archived'):
+                entry.restored = False
+                await self.archive.delete(state.key)
+
+        self._schedule_eviction()
+
+
+    async def reset(self, state: FSMContext):
+        '''Start a fresh session'''
+        self.cancel_prewarm(state.key)
+        self._drop(state.key)
+        self._evicted.pop(state.key, None)
+        async with self._lock(state.key):
+            session = (await state.get_data()).get('session') or {}
+            await state.update_data(session={'epoch': session.get('epoch', 0) + 1})
+            if session.get('archived'):
+                await self.archive.delete(state.key)
+
+
+    def prewarm(self, state: FSMContext, data: Dict, tg_id: int):
+        '''
+        Build and connect the chat of the current selection in the background
+
+        A warm-up for the same selection that is still running is reused, a
+        warm-up for a previous selection is cancelled.
+
+        :param state: FSM context of the user
+        :param data: FSM data after the selection
+        :param tg_id: Telegram id of the user
+        '''
+        active_character = data.get('active_character')
+        active_persona = data.get('active_persona')
+        if not (active_character and active_persona):
+            return
+
+        selection = (active_character.get('id'), active_persona.get('id'))
+        pending = self._prewarms.get(state.key)
+        if pending and pending[1] == selection and not pending[0].done():
+            return
+
+        self.cancel_prewarm(state.key)
+        task = asyncio.create_task(self._prewarm(state, data, tg_id))
+        self._prewarms[state.key] = (task, selection)
+        task.add_done_callback(lambda task, key=state.key: self._forget_prewarm(key, task))
+
+
+    def cancel_prewarm(self, key: StorageKey):
+        '''Cancel a running warm-up'''
+        pending = self._prewarms.pop(key, None)
+        if pending:
+            pending[0].cancel()
+
+
+    def _forget_prewarm(self, key: StorageKey, task: asyncio.Task):
+        pending = self._prewarms.get(key)
+        if pending and pending[0] is task:
+            del self._prewarms[key]
+
+
+    async def _prewarm(self, state: FSMContext, data: Dict, tg_id: int):
+        try:
+            chat = await self.get_chat(state, data, tg_id)
+            await chat.warm_up(PREWARM_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f'Error warming up chat: {e!r}')
+
+
+    def _lock(self, key: StorageKey) -> asyncio.Lock:
+        '''Lock serializing writes of one session to FSM storage'''
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+
+    def _count(self, entry: LiveSession):
+        '''Update the token total with the current history size of a chat'''
+        tokens = entry.chat.chat_history.total
+        self._tokens += tokens - entry.tokens
+        entry.tokens = tokens
+
+
+    def _put(self, key: StorageKey, entry: LiveSession) -> LiveSession:
+        self._drop(key)
+        self._chats[key] = entry
+        self._count(entry)
+        return entry
+
+
+    def _drop(self, key: StorageKey) -> Optional[LiveSession]:
+        entry = self._chats.pop(key, None)
+        if entry:
+            self._tokens -= entry.tokens
+        return entry
+
+
+    def _over_limit(self, entry: LiveSession) -> bool:
+        return (len(self._chats) > self.max_live or self._tokens > self.max_tokens
+                or time.monotonic() - entry.last_used >= self.idle_ttl)
+
+
+    def _schedule_eviction(self):
+        '''Start evicting in the background when the oldest chat is idle or there are too many'''
+        if self._eviction and not self._eviction.done():
+            return
+        oldest = next(iter(self._chats.values()), None)
+        if oldest is None:
+            return
+        if self._over_limit(oldest):
+            self._eviction = asyncio.create_task(self._evict())
+
+
+    async def _evict(self):
+        '''Drop least recently used chats past the idle TTL or the live limits and spill their history'''
+        while self._chats:
+            key, entry = next(iter(self._chats.items()))
+            if not self._over_limit(entry):
+                break
+
+            self._drop(key)
+            self._remember_evicted(key, entry)
+            self.counters['evictions'] += 1
+            try:
+                await self._spill(key, entry)
+            except Exception as e:
+                print(f'Error spilling session: {e}')
+
+
+    def _remember_evicted(self, key: StorageKey, entry: LiveSession):
+        '''Let a reply still being generated by an evicted chat be saved, for as long as the chat lives'''
+        def forget(ref: weakref.ref):
+            if self._evicted.get(key, (None,))[0] is ref:
+                del self._evicted[key]
+
+        self._evicted[key] = (weakref.ref(entry.chat, forget), entry.epoch)
+
+
+    async def _spill(self, key: StorageKey, entry: 'LiveSession'):
+        '''Move the history of an evicted chat from FSM data into the archive'''
+        async with self._lock(key):
+            # The chat was built again before the spill got the lock
+            if key in self._chats:
+                return
+            session = (await entry.state.get_data()).get('session')
+            # Nothing saved yet, or a newer version was written since
+            if not session or not session.get('history') or session.get('version') != entry.version:
+                return
+
+            await self.archive.put(key, session['history'])
+            await entry.state.update_data(session={**session, 'history': None, 'archived': True})
+            self.counters['spills'] += 1
+
+
+    def stats(self) -> Dict[str, int]:
+        '''Live chats, their history tokens and eviction counters'''
+        return {'live': len(self._chats), 'tokens': self._tokens, **self.counters}
+
+
+    async def close(self):
+        '''Stop evicting and close the archive connection'''
+        if self._eviction:
+            self._eviction.cancel()
+            await asyncio.gather(self._eviction, return_exceptions=True)
+        await self.archive.close()
+
+
+
+sessions = SessionManager()
+
+session_stats = CollectedGauge('rolebot_sessions', 'Live chats and idle session eviction counters', sessions.stats)
@@ -19,6 +19,11 @@ class Persona(StatesGroup):
     
 
 
+class Library(StatesGroup):
+    import_file = State()
+
+
+
 class PersonaState(StatesGroup):
     active_persona = State()
 
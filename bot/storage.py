@@ -0,0 +1,214 @@
+import os
+import json
+import zlib
+import asyncio
+from typing import Any, Dict, Optional
+
+import aiosqlite
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_DATABASE_PATH = os.getenv('FSM_DATABASE_PATH', 'fsm.sqlite3')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+SESSION_ARCHIVE_PATH = os.getenv('SESSION_ARCHIVE_PATH', 'sessions.sqlite3')
+SESSION_ARCHIVE_CODEC = os.getenv('SESSION_ARCHIVE_CODEC', 'zstd' if zstandard else 'zlib')
+
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str = FSM_DATABASE_PATH, key_builder: Optional[KeyBuilder] = None):
+        '''
+        FSM storage kept in a SQLite file
+
+        State and data survive restarts and can be shared by several bot
+        processes on one host. Data must be JSON serializable.
+
+        :param path: path to the SQLite file
+        :param key_builder: storage key builder
+        '''
+        self.path = path
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self._connection: Optional[aiosqlite.Connection] = None
+        self._lock = asyncio.Lock()
+
+
+    async def _connect(self) -> aiosqlite.Connection:
+        '''Open the connection and create the table on first use'''
+        if self._connection:
+            return self._connection
+
+        async with self._lock:
+            if not self._connection:
+                connection = await aiosqlite.connect(self.path)
+                await connection.execute('PRAGMA journal_mode=WAL')
+                await connection.execute(
+                    'CREATE TABLE IF NOT EXISTS fsm_storage ('
+                    'key TEXT PRIMARY KEY, state TEXT, data TEXT)'
+                )
+                await connection.commit()
+                self._connection = connection
+        return self._connection
+
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        connection = await self._connect()
+        value = state.state if isinstance(state, State) else state
+        await connection.execute(
+            'INSERT INTO fsm_storage (key, state) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET state = excluded.state',
+            (self.key_builder.build(key), value)
+        )
+        await connection.commit()
+
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        connection = await self._connect()
+        async with connection.execute(
+            'SELECT state FROM fsm_storage WHERE key = ?', (self.key_builder.build(key),)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        connection = await self._connect()
+        await connection.execute(
+            'INSERT INTO fsm_storage (key, data) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET data = excluded.data',
+            (self.key_builder.build(key), json.dumps(data, ensure_ascii=False))
+        )
+        await connection.commit()
+
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        connection = await self._connect()
+        async with connection.execute(
+            'SELECT data FROM fsm_storage WHERE key = ?', (self.key_builder.build(key),)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+
+    async def close(self) -> None:
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
+
+
+
+class SessionArchive:
+    def __init__(self, path: str = SESSION_ARCHIVE_PATH, codec: str = SESSION_ARCHIVE_CODEC,
+                 key_builder: Optional[KeyBuilder] = None):
+        '''
+        Compressed store of chat histories of idle sessions
+
+        Histories are kept as compressed JSON in a SQLite file, one row per
+        FSM key. Rows remember their codec, so switching codecs keeps old
+        rows readable.
+
+        :param path: path to the SQLite file
+        :param codec: 'zstd' (requires the zstandard package) or 'zlib'
+        :param key_builder: storage key builder
+        '''
+        if codec == 'zstd' and not zstandard:
+            raise RuntimeError('zstd session archive requires the zstandard package')
+
+        self.path = path
+        self.codec = codec
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self._connection: Optional[aiosqlite.Connection] = None
+        self._lock = asyncio.Lock()
+
+
+    async def _connect(self) -> aiosqlite.Connection:
+        '''Open the connection and create the table on first use'''
+        if self._connection:
+            return self._connection
+
+        async with self._lock:
+            if not self._connection:
+                connection = await aiosqlite.connect(self.path)
+                await connection.execute('PRAGMA journal_mode=WAL')
+                await connection.execute(
+                    'CREATE TABLE IF NOT EXISTS session_archive ('
+                    'key TEXT PRIMARY KEY, codec TEXT NOT NULL, data BLOB NOT NULL)'
+                )
+                await connection.commit()
+                self._connection = connection
+        return self._connection
+
+
+    def _compress(self, payload: bytes) -> bytes:
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compress(payload)
+        return zlib.compress(payload, 6)
+
+
+    @staticmethod
+    def _decompress(codec: str, data: bytes) -> bytes:
+        if codec == 'zstd':
+            if not zstandard:
+                raise RuntimeError('zstd session archive requires the zstandard package')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+
+    async def put(self, key: StorageKey, history: Dict[str, Any]):
+        '''Store a dumped history, replacing an older one'''
+        data = self._compress(json.dumps(history, ensure_ascii=False).encode())
+        connection = await self._connect()
+        await connection.execute(
+            'INSERT INTO session_archive (key, codec, data) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET codec = excluded.codec, data = excluded.data',
+            (self.key_builder.build(key), self.codec, data)
+        )
+        await connection.commit()
+
+
+    async def get(self, key: StorageKey) -> Optional[Dict[str, Any]]:
+        '''Load a dumped history, None if there is none'''
+        connection = await self._connect()
+        async with connection.execute(
+            'SELECT codec, data FROM session_archive WHERE key = ?', (self.key_builder.build(key),)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(self._decompress(row[0], row[1])) if row else None
+
+
+    async def delete(self, key: StorageKey):
+        connection = await self._connect()
+        await connection.execute('DELETE FROM session_archive WHERE key = ?', (self.key_builder.build(key),))
+        await connection.commit()
+
+
+    async def close(self):
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
+
+
+
+def create_storage() -> BaseStorage:
+    '''
+    Create FSM storage selected by FSM_STORAGE
+
+    :return: memory, sqlite or redis storage
+    '''
+    if FSM_STORAGE == 'memory':
+        return MemoryStorage()
+
+    if FSM_STORAGE == 'redis':
+        # redis is an optional dependency, only needed for this backend
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL)
+
+    return SQLiteStorage()
@@ -0,0 +1,84 @@
+import os
+import asyncio
+import time
+from typing import AsyncIterator
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_PLACEHOLDER = '...'
+
+
+
+async def _edit(sent: Message, text: str, wait: bool = False) -> float:
+    '''
+    Edit a sent message
+
+    :param sent: message to edit
+    :param text: new message text
+    :param wait: sleep through flood control instead of skipping the edit
+    :return: seconds Telegram asked to hold off further edits
+    '''
+    while True:
+        try:
+            await sent.edit_text(text)
+            return 0.0
+
+        except TelegramRetryAfter as e:
+            if not wait:
+                return float(e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                return 0.0
+            raise
+
+
+
+async def stream_answer(message: Message, chunks: AsyncIterator[str]) -> str:
+    '''
+    Answer a message with a streamed reply
+
+    Sends a placeholder first and then edits it as chunks arrive, at most once
+    per STREAM_EDIT_INTERVAL. Text past Telegram's message limit rolls over
+    into a new message.
+
+    :param message: message to answer
+    :param chunks: async iterator over reply text chunks
+    :return: full reply text
+    '''
+    sent = await message.answer(STREAM_PLACEHOLDER)
+    full_text = ''
+    current = ''
+    shown = ''
+    next_edit = 0.0
+
+    async for chunk in chunks:
+        full_text += chunk
+        current += chunk
+
+        while len(current) > TELEGRAM_MESSAGE_LIMIT:
+            if shown != current[:TELEGRAM_MESSAGE_LIMIT]:
+                await _edit(sent, current[:TELEGRAM_MESSAGE_LIMIT], wait=True)
+            current = current[TELEGRAM_MESSAGE_LIMIT:]
+            # A single large chunk can still be over the limit, the loop keeps splitting it
+            shown = current[:TELEGRAM_MESSAGE_LIMIT]
+            sent = await message.answer(shown)
+            next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+        now = time.monotonic()
+        if current != shown and now >= next_edit:
+            retry_after = await _edit(sent, current)
+            if not retry_after:
+                shown = current
+            next_edit = now + max(STREAM_EDIT_INTERVAL, retry_after)
+
+    if current and current != shown:
+        await _edit(sent, current, wait=True)
+
+    return full_text
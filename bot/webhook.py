@@ -0,0 +1,127 @@
+import os
+import asyncio
+import secrets
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+
+
+
+async def health(request: web.Request) -> web.Response:
+    '''Liveness probe for load balancers'''
+    return web.json_response({'status': 'ok'})
+
+
+
+def create_app(dp: Dispatcher, bot: Bot) -> web.Application:
+    '''
+    Build the webhook application
+
+    Updates are acknowledged right away and handled in background tasks.
+    Requests without the expected secret token header are rejected.
+
+    :param dp: dispatcher with included routers
+    :param bot: bot instance
+    :return: aiohttp application
+    '''
+    app = web.Application()
+    app.router.add_get('/health', health)
+
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    return app
+
+
+
+def create_front_app(dispatch: Callable[[Dict[str, Any]], None]) -> web.Application:
+    '''
+    Build the webhook application of the supervisor
+
+    Raw updates are passed to dispatch and handled by worker processes.
+
+    :param dispatch: receives every update as a dictionary
+    :return: aiohttp application
+    '''
+    async def receive(request: web.Request) -> web.Response:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401, text='Unauthorized')
+        dispatch(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get('/health', health)
+    app.router.add_post(WEBHOOK_PATH, receive)
+    return app
+
+
+
+def check_webhook_config():
+    '''
+    Refuse to serve a webhook that is unreachable or unauthenticated
+
+    The secret must be configured, not generated: every instance behind a load
+    balancer registers it, and all of them have to accept the same one.
+    '''
+    if not WEBHOOK_URL:
+        raise RuntimeError('WEBHOOK_URL must be set in webhook mode')
+    if not WEBHOOK_SECRET:
+        raise RuntimeError('WEBHOOK_SECRET must be set in webhook mode')
+
+
+
+async def register_webhook(bot: Bot, allowed_updates: Optional[List[str]] = None):
+    '''Point Telegram at WEBHOOK_URL'''
+    check_webhook_config()
+
+    await bot.set_webhook(
+        f'{WEBHOOK_URL.rstrip("/")}{WEBHOOK_PATH}',
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=allowed_updates
+    )
+
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    '''Register the webhook with Telegram and serve updates until cancelled'''
+    check_webhook_config()
+
+    dp.startup.register(register_webhook)
+    await serve(create_app(dp, bot))
+
+
+
+async def run_webhook_front(bot: Bot, dispatch: Callable[[Dict[str, Any]], None],
+                            allowed_updates: Optional[List[str]] = None):
+    '''Register the webhook and pass updates to dispatch until cancelled'''
+    check_webhook_config()
+    await register_webhook(bot, allowed_updates)
+    await serve(create_front_app(dispatch))
+
+
+
+async def serve(app: web.Application):
+    '''Serve an application on WEBAPP_HOST:WEBAPP_PORT until cancelled'''
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT).start()
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,211 @@
+import os
+import zlib
+import asyncio
+import multiprocessing
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.utils.backoff import Backoff, BackoffConfig
+
+from bot.handlers import router
+from bot.metrics import METRICS_PORT, start_metrics_server
+from bot.sessions import sessions
+from bot.storage import create_storage
+from bot.webhook import run_webhook_front
+
+
+
+WORKERS = int(os.getenv('WORKERS', '1'))
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', '30'))
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv('WORKER_SHUTDOWN_TIMEOUT', '10'))
+
+# gRPC and SQLite connections do not survive fork()
+_context = multiprocessing.get_context('spawn')
+
+
+
+def chat_id_of(update: Dict[str, Any]) -> int:
+    '''Chat an update belongs to, or its sender when there is no chat'''
+    for field, event in update.items():
+        if field == 'update_id' or not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+    return 0
+
+
+
+def shard_of(update: Dict[str, Any], workers: int) -> int:
+    '''Worker index of an update, stable across restarts'''
+    return zlib.crc32(str(chat_id_of(update)).encode()) % workers
+
+
+
+''' Worker '''
+
+def run_worker(index: int, token: str, queue: multiprocessing.Queue):
+    '''Worker process entry point'''
+    try:
+        asyncio.run(_serve_shard(index, token, queue))
+    except KeyboardInterrupt:
+        pass
+
+
+
+async def _feed(dp: Dispatcher, bot: Bot, update: Dict[str, Any]):
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception as e:
+        print(f'Error handling update {update.get("update_id")}: {e}')
+
+
+
+async def _serve_shard(index: int, token: str, queue: multiprocessing.Queue):
+    '''
+    Handle the updates of one shard until the stop sentinel
+
+    Updates are started in queue order, each as its own task like in polling
+    mode, so every chat sees its updates in the order Telegram sent them.
+    '''
+    bot = Bot(token=token)
+    dp = Dispatcher(storage=create_storage())
+    dp.include_router(router)
+    metrics = await start_metrics_server(port=METRICS_PORT + 1 + index) if METRICS_PORT else None
+
+    loop = asyncio.get_running_loop()
+    tasks: Set[asyncio.Task] = set()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            task = asyncio.create_task(_feed(dp, bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await dp.storage.close()
+        await sessions.close()
+        await bot.session.close()
+        if metrics:
+            await metrics.cleanup()
+
+
+
+''' Supervisor '''
+
+class Supervisor:
+    def __init__(self, token: str, workers: int = WORKERS):
+        '''
+        Worker processes with one update queue each
+
+        Updates are partitioned by a hash of the chat id, so a chat and its
+        session always live on the same worker. A worker that dies is
+        restarted on the same queue.
+
+        :param token: bot token for the workers
+        :param workers: number of worker processes
+        '''
+        self.token = token
+        self.queues = [_context.Queue() for _ in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+
+
+    def _spawn(self, index: int):
+        process = _context.Process(
+            target=run_worker,
+            args=(index, self.token, self.queues[index]),
+            name=f'rolebot-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+
+
+    def dispatch(self, update: Dict[str, Any]):
+        '''Hand a raw update to the worker of its chat'''
+        self.queues[shard_of(update, len(self.queues))].put(update)
+
+
+    async def watch(self, interval: float = 1.0):
+        '''Restart workers that exited'''
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if process and not process.is_alive():
+                    print(f'Worker {index} exited with code {process.exitcode}, restarting')
+                    self._spawn(index)
+
+
+    def stop(self, timeout: float = WORKER_SHUTDOWN_TIMEOUT):
+        '''Let workers finish queued updates, then terminate the ones still running'''
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            if process:
+                process.join(timeout)
+                if process.is_alive():
+                    process.terminate()
+
+
+
+async def poll(bot: Bot, dispatch: Callable[[Dict[str, Any]], None],
+               allowed_updates: Optional[List[str]] = None):
+    '''Long-poll Telegram and dispatch every update'''
+    backoff = Backoff(config=BackoffConfig(min_delay=1.0, max_delay=5.0, factor=1.3, jitter=0.1))
+    offset = None
+
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=allowed_updates,
+                request_timeout=int(bot.session.timeout + POLLING_TIMEOUT)
+            )
+        except Exception as e:
+            print(f'Failed to fetch updates: {e}')
+            await backoff.asleep()
+            continue
+
+        backoff.reset()
+        for update in updates:
+            dispatch(update.model_dump(mode='json', by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+
+
+async def run_supervisor(bot: Bot, mode: str, allowed_updates: Optional[List[str]] = None,
+                         workers: int = WORKERS):
+    '''
+    Receive updates in this process and handle them in worker processes
+
+    :param bot: bot used for polling or webhook registration
+    :param mode: 'polling' or 'webhook'
+    :param allowed_updates: update types to receive
+    :param workers: number of worker processes
+    '''
+    supervisor = Supervisor(bot.token, workers)
+    supervisor.start()
+    watcher = asyncio.create_task(supervisor.watch())
+
+    try:
+        if mode == 'webhook':
+            await run_webhook_front(bot, supervisor.dispatch, allowed_updates)
+        else:
+            await poll(bot, supervisor.dispatch, allowed_updates)
+    finally:
+        watcher.cancel()
+        supervisor.stop()
+        await bot.session.close()
@@ -9,18 +9,38 @@ import logging
 
 from bot.handlers import router
 from bot.database.models import async_main
+from bot.metrics import start_metrics_server
+from bot.sessions import sessions
+from bot.storage import create_storage
+from bot.webhook import run_webhook
+from bot.workers import WORKERS, run_supervisor
 
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
 
 bot = ag.Bot(token=TELEGRAM_BOT_TOKEN)
-dp = ag.Dispatcher()
+dp = ag.Dispatcher(storage=create_storage())
 
 
 async def main():
     await async_main()
     dp.include_router(router)
-    await dp.start_polling(bot)
+    dp.shutdown.register(sessions.close)
+
+    if WORKERS > 1:
+        await run_supervisor(bot, BOT_MODE, dp.resolve_used_update_types())
+        return
+
+    metrics = await start_metrics_server()
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if metrics:
+            await metrics.cleanup()
 
 if __name__ == '__main__':
     if os.getenv('DEBUG_MODE', 'false'):
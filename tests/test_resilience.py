@@ -0,0 +1,43 @@
+import asyncio
+
+from google.api_core import exceptions
+
+from LLM.pool import create_client
+from LLM.resilience import Resilience
+
+
+
+class QuotaClient:
+    '''Async API client stub answering every request with 429'''
+
+    def __init__(self):
+        self.requests = 0
+
+    async def generate_content(self, **kwargs):
+        self.requests += 1
+        raise exceptions.ResourceExhausted('quota exceeded')
+
+
+
+def test_quota_errors_are_retried_once_per_attempt():
+    async def main():
+        client = create_client('test-key', 'gemini-2.0-flash', 0.7)
+        stub = QuotaClient()
+        client.async_client_running = stub
+        resilience = Resilience(attempts=3, base_delay=0.0)
+
+        try:
+            await resilience.call('test-key', lambda: client.ainvoke('Hello'))
+        except exceptions.ResourceExhausted:
+            pass
+        else:
+            raise AssertionError('quota error was swallowed')
+
+        breaker = resilience.breaker('test-key')
+        # One request per attempt, each counted by the breaker, which opens on the third
+        assert stub.requests == 3
+        assert breaker.failures == 3
+        assert breaker.is_open()
+        assert resilience.counters['retries'] == 2
+
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+import asyncio
+
+from LLM.scheduler import GenerationScheduler
+
+
+
+async def hold(scheduler: GenerationScheduler, key: str, order: list, release: asyncio.Event):
+    async with scheduler.slot(key):
+        order.append(key)
+        await release.wait()
+
+
+
+def test_cancel_during_release():
+    async def main():
+        scheduler = GenerationScheduler(max_concurrent=1, per_key=1)
+        release = asyncio.Event()
+        order = []
+
+        holder = asyncio.create_task(hold(scheduler, 'a', order, release))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold(scheduler, 'b', order, asyncio.Event()))
+        await asyncio.sleep(0)
+        assert scheduler.queued == 1
+
+        # The slot is handed over in the same iteration the waiter is cancelled
+        release.set()
+        waiter.cancel()
+        await holder
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        assert waiter.cancelled()
+        assert scheduler.running == 0 and scheduler.queued == 0
+
+        third = asyncio.create_task(hold(scheduler, 'c', order, release))
+        await asyncio.wait_for(third, 1)
+        assert order == ['a', 'c']
+
+    asyncio.run(main())
+
+
+
+def test_round_robin_across_keys():
+    async def main():
+        scheduler = GenerationScheduler(max_concurrent=1, per_key=1)
+        gate = asyncio.Event()
+        order = []
+
+        first = asyncio.create_task(hold(scheduler, 'a', order, gate))
+        await asyncio.sleep(0)
+        # Key a queues three calls before b and c queue one each
+        tasks = [asyncio.create_task(hold(scheduler, key, order, gate)) for key in ('a', 'a', 'a', 'b', 'c')]
+        await asyncio.sleep(0)
+        assert scheduler.queued == 5
+
+        gate.set()
+        await asyncio.wait_for(asyncio.gather(first, *tasks), 1)
+
+        assert order == ['a', 'a', 'b', 'c', 'a', 'a']
+        assert scheduler.running == 0 and scheduler.queued == 0
+
+    asyncio.run(main())